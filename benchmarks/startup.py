@@ -0,0 +1,74 @@
+"""times how long the mariposa command line takes to report its status
+
+    python benchmarks/startup.py [--runs 20] [--max-ms 250]
+
+exits with a failure when the median status check takes longer than
+--max-ms so a slow import can be caught before it reaches health checks"""
+from optparse import OptionParser
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def mariposa(directory, *args):
+    return [sys.executable, '-m', 'mariposa.core', '-d', directory] + list(
+        args)
+
+
+def median_ms(command, runs, env):
+    timings = []
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_call(command, env=env, stdout=subprocess.PIPE)
+        timings.append((time.time() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--runs', type='int', default=20)
+    parser.add_option('--migrations', type='int', default=100)
+    parser.add_option('--max-ms', type='float')
+    options, args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    work = tempfile.mkdtemp()
+    env['XDG_CACHE_HOME'] = os.path.join(work, 'cache')
+    try:
+        directory = os.path.join(work, 'migrations')
+        os.mkdir(directory)
+        for i in range(options.migrations):
+            with open(os.path.join(directory, '%06d-t.sql' % i), 'w') as f:
+                f.write('CREATE TABLE t%d (id int);\n' % i)
+        database = os.path.join(work, 'test.db')
+        snapshot = os.path.join(work, 'performed.json')
+        subprocess.check_call(
+            mariposa(directory, '-c', database, '--snapshot', snapshot,
+                     'migrate'), env=env)
+
+        results = [
+            ('python', [sys.executable, '-c', 'pass']),
+            ('import', [sys.executable, '-c', 'import mariposa.core']),
+            ('status', mariposa(directory, '-c', database, 'status')),
+            ('status --snapshot',
+             mariposa(directory, '--snapshot', snapshot, 'status')),
+        ]
+        for name, command in results:
+            print('%-20s %8.1f ms' % (
+                name, median_ms(command, options.runs, env)))
+        slowest = median_ms(results[-1][1], options.runs, env)
+    finally:
+        shutil.rmtree(work)
+    if options.max_ms is not None and slowest > options.max_ms:
+        sys.exit('status took %.1f ms (more than %.1f ms)' % (
+            slowest, options.max_ms))
+
+
+if __name__ == '__main__':
+    main()
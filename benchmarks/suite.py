@@ -0,0 +1,223 @@
+"""times the main paths of mariposa against synthetic migration histories
+
+    python benchmarks/suite.py [--sizes 100,10000,100000] [--giant-mb 16]
+                               [--output results.json] [--compare old.json]
+
+every benchmark runs against sqlite in memory and the fastest of --repeat
+runs is reported. results are written as JSON (to stdout without
+--output) and --compare prints how each benchmark changed since an earlier
+results file"""
+from optparse import OptionParser
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mariposa  # noqa: E402
+from mariposa.core import DBMigrate, pending_migrations  # noqa: E402
+
+
+def write_history(directory, size):
+    """writes size migrations that each insert a row into one table"""
+    os.mkdir(directory)
+    for i in range(size):
+        with open(os.path.join(directory, '%08d-m.sql' % i), 'w') as f:
+            if i == 0:
+                f.write('CREATE TABLE t (id int, name varchar(255));\n')
+            else:
+                f.write("INSERT INTO t VALUES (%d, 'migration %d');\n" % (
+                    i, i))
+        # old enough for the checksum cache to trust
+        os.utime(os.path.join(directory, '%08d-m.sql' % i), (1, 1))
+
+
+def write_giant(directory, megabytes):
+    """writes a single migration of about megabytes of inserts"""
+    os.mkdir(directory)
+    path = os.path.join(directory, '00000000-giant.sql')
+    with open(path, 'w') as f:
+        f.write('CREATE TABLE t (id int, name varchar(255));\n')
+        written = i = 0
+        while written < megabytes * 1024 * 1024:
+            line = "INSERT INTO t VALUES (%d, 'row %d');\n" % (i, i)
+            f.write(line)
+            written += len(line)
+            i += 1
+    os.utime(path, (1, 1))
+
+
+def mariposa_for(directory, **options):
+    settings = dict(
+        out_of_order=False, dry_run=False, engine='sqlite',
+        connection_string=':memory:', directory=directory)
+    settings.update(options)
+    return DBMigrate(**settings)
+
+
+def best_of(repeat, setup, run):
+    """returns the fastest time of run(setup()) in seconds"""
+    timings = []
+    for i in range(repeat):
+        state = setup()
+        start = time.time()
+        run(state)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def clear_cache():
+    shutil.rmtree(os.environ['XDG_CACHE_HOME'], ignore_errors=True)
+
+
+def history_benchmarks(directory, size, repeat):
+    """yields (name, seconds) for each path through a history"""
+    def cold():
+        clear_cache()
+        return mariposa_for(directory)
+    yield 'current_migrations (cold cache)', best_of(
+        repeat, cold, lambda m: m.current_migrations())
+    yield 'current_migrations (warm cache)', best_of(
+        repeat, lambda: mariposa_for(directory),
+        lambda m: m.current_migrations())
+
+    current = mariposa_for(directory).current_migrations()
+    half = sorted(current)[:size // 2]
+    yield 'pending_migrations (half performed)', best_of(
+        repeat, lambda: None, lambda m: pending_migrations(current, half))
+    # a performed migration that's gone makes the planner walk everything
+    gap = current[:size // 4] + current[size // 4 + 1:]
+    yield 'pending_migrations (one deleted)', best_of(
+        repeat, lambda: None, lambda m: pending_migrations(gap, half))
+
+    yield 'migrate --dry-run', best_of(
+        repeat, lambda: mariposa_for(directory, dry_run=True),
+        lambda m: m.migrate())
+
+    yield 'migrate', best_of(
+        repeat, lambda: mariposa_for(directory), lambda m: m.migrate())
+    yield 'migrate --batch', best_of(
+        repeat, lambda: mariposa_for(directory, batch=True),
+        lambda m: m.migrate())
+
+    def migrated():
+        m = mariposa_for(directory, batch=True)
+        m.migrate()
+        return m
+    yield 'migrate (up to date)', best_of(
+        repeat, migrated, lambda m: m.migrate())
+
+    def renumbered():
+        # every tenth migration was renamed after it was performed
+        m = migrated()
+        m.dry_run = True
+        m.migrations = [
+            migration._replace(filename='r' + migration.filename)
+            if i % 10 == 0 else migration
+            for i, migration in enumerate(current)]
+        return m
+    yield 'renamed --dry-run', best_of(
+        repeat, renumbered, lambda m: m.renamed())
+
+
+def giant_benchmarks(directory, repeat):
+    def cold():
+        clear_cache()
+        return mariposa_for(directory)
+    yield 'current_migrations (cold cache)', best_of(
+        repeat, cold, lambda m: m.current_migrations())
+    yield 'migrate --dry-run', best_of(
+        repeat, lambda: mariposa_for(directory, dry_run=True),
+        lambda m: m.migrate())
+    yield 'migrate', best_of(
+        repeat, lambda: mariposa_for(directory), lambda m: m.migrate())
+
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))
+            ).decode('UTF-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """returns a line for each benchmark in both results files"""
+    before = dict(((r['history'], r['name']), r['seconds'])
+                  for r in old['results'])
+    lines = []
+    for result in new['results']:
+        key = (result['history'], result['name'])
+        if key in before and before[key]:
+            lines.append('%-20s %-40s %9.3fs %9.3fs %7.2fx' % (
+                result['history'], result['name'], before[key],
+                result['seconds'], result['seconds'] / before[key]))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--sizes', default='100,10000,100000',
+                      help='comma separated number of migrations')
+    parser.add_option('--giant-mb', type='int', default=16,
+                      help='size of the giant migration (0 to skip)')
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--output', help='file to write the results to')
+    parser.add_option('--compare', help='earlier results to compare with')
+    options, args = parser.parse_args()
+
+    work = tempfile.mkdtemp()
+    os.environ['XDG_CACHE_HOME'] = os.path.join(work, 'cache')
+    results = []
+
+    def record(history, benchmarks):
+        for name, seconds in benchmarks:
+            sys.stderr.write('%-20s %-40s %9.4fs\n' % (history, name, seconds))
+            results.append(
+                {'history': history, 'name': name, 'seconds': seconds})
+    try:
+        for size in [int(s) for s in options.sizes.split(',') if s]:
+            directory = os.path.join(work, '%d' % size)
+            write_history(directory, size)
+            record('%d files' % size,
+                   history_benchmarks(directory, size, options.repeat))
+            shutil.rmtree(directory)
+        if options.giant_mb:
+            directory = os.path.join(work, 'giant')
+            write_giant(directory, options.giant_mb)
+            record('%d MB file' % options.giant_mb,
+                   giant_benchmarks(directory, options.repeat))
+    finally:
+        shutil.rmtree(work)
+
+    report = {
+        'version': mariposa.__version__,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if options.compare:
+        with open(options.compare) as f:
+            sys.stderr.write(compare(json.load(f), report) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import collections
+import functools
+import logging
+import os
+import time
+from mariposa import dbengines, tracing
+from mariposa.core import DBMigrate
+from mariposa.dbengines import FilenameSha1
+
+
+logger = logging.getLogger(__name__)
+
+PlannedMigration = collections.namedtuple(
+    'PlannedMigration', 'filename sha1 script')
+
+
+class Result(object):
+    """what migrate did (or would have done on a dry run)
+
+    planned lists the migrations that were pending in the order they are
+    run, performed the ones that were recorded in the migration table and
+    baseline the filename of the baseline applied to an empty database"""
+
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.planned = []
+        self.performed = []
+        self.baseline = None
+        self.warnings = []
+        self.duration = None
+
+    @property
+    def up_to_date(self):
+        return not self.planned and self.baseline is None
+
+    def __repr__(self):
+        return '<Result %d planned, %d performed%s>' % (
+            len(self.planned), len(self.performed),
+            ' (dry run)' if self.dry_run else '')
+
+
+class ResultTracer(tracing.Tracer):
+    """fills in a result as migrate runs
+
+    paths has the location of migrations that are in subdirectories"""
+
+    # files are enough so postgres keeps pipelining batches
+    wants_statements = False
+
+    def __init__(self, result, directory, paths=None):
+        self.result = result
+        self.directory = directory
+        self.paths = {} if paths is None else paths
+
+    def plan_computed(self, migrations, duration):
+        self.result.planned = [
+            PlannedMigration(filename, sha1, dbengines.migration_type(
+                self.paths.get(filename) or
+                os.path.join(self.directory, filename)) is None)
+            for filename, sha1 in migrations]
+
+    def file_finished(self, migration, duration, error=None):
+        if error is not None:
+            return
+        if isinstance(migration, dbengines.BaselineMigration):
+            self.result.baseline = migration.filename
+        else:
+            self.result.performed.append(
+                FilenameSha1(migration.filename, migration.sha1))
+
+
+def migrate(directory, connection=None, pool=None, engine='sqlite',
+            connection_string=None, dry_run=False, out_of_order=False,
+            **options):
+    """migrates a database from inside of an application and returns a Result
+
+    the database is reached through an open DB-API connection, a pool with
+    getconn and putconn methods or a connection string (in that order of
+    preference). a connection that is passed in is left open. warnings are
+    logged and collected in the result instead of being written to stderr.
+    any other options are passed along to DBMigrate"""
+    result = Result(dry_run)
+    mariposa = DBMigrate(
+        out_of_order=out_of_order, dry_run=dry_run, engine=engine,
+        connection_string=connection_string, directory=directory,
+        connection=connection, pool=pool, **options)
+    mariposa.tracer.append(ResultTracer(result, directory, mariposa.paths))
+
+    def warn(message):
+        logger.warning(message)
+        result.warnings.append(message)
+    mariposa.warn = warn
+    start = time.time()
+    try:
+        mariposa.migrate()
+    finally:
+        mariposa.close()
+    result.duration = time.time() - start
+    return result
+
+
+def migrate_async(*args, **kwargs):
+    """returns an asyncio future of migrate's Result
+
+    migrate runs on executor (the event loop's default executor when it
+    isn't given) so the loop can get on with other work in the meantime.
+    this has to be called while the event loop is running"""
+    import asyncio
+    executor = kwargs.pop('executor', None)
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(
+        executor, functools.partial(migrate, *args, **kwargs))
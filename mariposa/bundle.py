@@ -0,0 +1,163 @@
+import contextlib
+import errno
+import hashlib
+import io
+import mmap
+import os
+import shutil
+import stat
+from mariposa.checksums import blob_sha1, stat_key
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+# a bundle starts with this line, the length of the index on a line of its
+# own and the index, which is followed by the contents of every file
+MAGIC = b'mariposa bundle 1\n'
+
+
+class BundleException(Exception):
+    pass
+
+
+class Bundle(object):
+    """a migration directory packed into a single file
+
+    the index lists the filename, sha1, offset, length and mode of every
+    file. the contents are mapped into memory so only the files that are
+    read are ever touched"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.readline() != MAGIC:
+                raise BundleException('%s is not a migration bundle' % path)
+            length = int(f.readline())
+            self.index = dict(
+                (entry[0], entry[1:])
+                for entry in json.loads(f.read(length).decode('UTF-8')))
+            self.start = f.tell()
+            size = os.fstat(f.fileno()).st_size
+            self.contents = None
+            if size > self.start:
+                self.contents = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def filenames(self):
+        return sorted(self.index)
+
+    def sha1(self, filename):
+        return self.index[filename][0]
+
+    def mode(self, filename):
+        return self.index[filename][3]
+
+    def read(self, filename):
+        """returns the contents of a file after checking them against the
+        sha1 in the index"""
+        if filename not in self.index:
+            raise IOError(errno.ENOENT, 'No such file in %s' % self.path,
+                          filename)
+        sha1, offset, length, mode = self.index[filename]
+        if length:
+            offset += self.start
+            contents = self.contents[offset:offset + length]
+        else:
+            contents = b''
+        s = hashlib.sha1(('blob %u\0' % length).encode('UTF-8'))
+        s.update(contents)
+        if s.hexdigest() != sha1:
+            raise BundleException(
+                '%s in %s does not match its sha1' % (filename, self.path))
+        return contents
+
+
+def is_bundle(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+# bundles that have been opened and the stat information they were opened
+# with so a bundle that is replaced gets opened again
+_bundles = {}
+
+
+def load(path):
+    """returns the bundle at path or None when path isn't a bundle"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    key = stat_key(st)
+    if path not in _bundles or _bundles[path][0] != key:
+        if not is_bundle(path):
+            return None
+        _bundles[path] = (key, Bundle(path))
+    return _bundles[path][1]
+
+
+def open_migration(path, newline=None):
+    """opens a migration for reading as text whether it's a file in a
+    directory or in a bundle"""
+    directory, filename = os.path.split(path)
+    bundle = load(directory)
+    if bundle is None:
+        return open(path, newline=newline)
+    return io.TextIOWrapper(
+        io.BytesIO(bundle.read(filename)), newline=newline)
+
+
+@contextlib.contextmanager
+def extracted(path):
+    """yields a path that a script in a bundle can be run from"""
+    directory, filename = os.path.split(path)
+    bundle = load(directory)
+    if bundle is None:
+        yield path
+        return
+    import tempfile
+    temporary = tempfile.mkdtemp()
+    try:
+        script = os.path.join(temporary, filename)
+        with open(script, 'wb') as f:
+            f.write(bundle.read(filename))
+        os.chmod(script, stat.S_IMODE(bundle.mode(filename)))
+        yield script
+    finally:
+        shutil.rmtree(temporary)
+
+
+def write(path, files):
+    """packs (filename, path) files into a bundle at path, flattening any
+    subdirectories they were in"""
+    files = sorted(files)
+    index = []
+    offset = 0
+    for filename, source in files:
+        st = os.stat(source)
+        index.append(
+            [filename, blob_sha1(source), offset, st.st_size, st.st_mode])
+        offset += st.st_size
+    temporary = '%s.%d' % (path, os.getpid())
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(MAGIC)
+            encoded = json.dumps(index).encode('UTF-8')
+            f.write(('%d\n' % len(encoded)).encode('UTF-8'))
+            f.write(encoded)
+            start = f.tell()
+            for (filename, source), entry in zip(files, index):
+                offset, length = entry[2:4]
+                with open(source, 'rb') as contents:
+                    shutil.copyfileobj(contents, f)
+                if f.tell() - start != offset + length:
+                    raise BundleException(
+                        '%s changed while it was being bundled' % filename)
+        os.rename(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
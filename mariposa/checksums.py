@@ -0,0 +1,211 @@
+import hashlib
+import logging
+import mmap
+import os
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+logger = logging.getLogger(__name__)
+
+# the most of a migration that is handed to sha1 at once when hashing
+CHUNK_SIZE = 1024 * 1024
+
+
+def blob_sha1(filename):
+    """returns the git blob sha1 of a file
+
+    the file is streamed (through mmap when the platform allows it) so
+    memory use doesn't grow with the size of the migration"""
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        contents = None
+        if size:
+            try:
+                contents = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                # special files and some filesystems can't be mapped
+                pass
+        if contents is None:
+            s = hashlib.sha1(('blob %u\0' % size).encode('UTF-8'))
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                s.update(chunk)
+            return s.hexdigest()
+        try:
+            size = len(contents)
+            s = hashlib.sha1(('blob %u\0' % size).encode('UTF-8'))
+            with memoryview(contents) as view:
+                for offset in range(0, size, CHUNK_SIZE):
+                    s.update(view[offset:offset + CHUNK_SIZE])
+        finally:
+            contents.close()
+        return s.hexdigest()
+
+
+def cache_directory():
+    """returns the directory mariposa keeps its caches in"""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'mariposa')
+
+
+def directory_key(directory):
+    """returns the name a migration directory's caches are kept under"""
+    return hashlib.sha1(
+        os.path.abspath(directory).encode('UTF-8')).hexdigest()
+
+
+def cache_path(directory):
+    """returns the location of the checksum cache for a migration directory
+
+    caches live outside of the migration directory so they never show up
+    as migrations or as untracked files in the project"""
+    return os.path.join(cache_directory(), directory_key(directory) + '.json')
+
+
+def migrations_digest(migrations):
+    """returns a sha1 of a set of (filename, sha1) pairs"""
+    s = hashlib.sha1()
+    for filename, sha1 in sorted(migrations):
+        s.update(('%s %s\n' % (filename, sha1)).encode('UTF-8'))
+    return s.hexdigest()
+
+
+def git_index_sha1s(directory):
+    """returns a dictionary of path (relative to directory) to sha1 for the
+    files under directory that are tracked by git and unmodified in the
+    working tree
+
+    this needs one read of the git index no matter how many migrations
+    there are. dirty and untracked files are left out so they get hashed
+    and an empty dictionary is returned outside of a git work tree.
+
+    the index has the sha1 of each file as git stores it, after line
+    ending conversion and clean filters (such as LFS), which is only the
+    sha1 of the file in the working tree when nothing was converted. files
+    with a filter or whose stored size differs from their size on disk
+    are left out too"""
+    import subprocess
+
+    def git(args, stdin=b''):
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen(
+                ['git'] + args, cwd=directory, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=devnull)
+            output = process.communicate(stdin)[0]
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, args)
+        return output.decode('UTF-8')
+    try:
+        staged = git(['ls-files', '--stage', '-z', '--', '.'])
+        modified = git(
+            ['diff-files', '--name-only', '--relative', '-z', '--', '.'])
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    modified = set(modified.split('\0'))
+    sha1s = {}
+    for entry in staged.split('\0'):
+        if not entry:
+            continue
+        info, filename = entry.split('\t', 1)
+        mode, sha1, stage = info.split()
+        # only regular files that aren't in the middle of a merge conflict
+        if (mode not in ('100644', '100755') or stage != '0' or
+                len(sha1) != 40 or filename in modified):
+            continue
+        sha1s[filename] = sha1
+    if not sha1s:
+        return sha1s
+    filenames = sorted(sha1s)
+    try:
+        sizes = git(['cat-file', '--batch-check'], ''.join(
+            sha1s[filename] + '\n' for filename in filenames
+        ).encode('UTF-8')).splitlines()
+        attributes = git(
+            ['check-attr', '-z', '--stdin', 'filter'],
+            ''.join(f + '\0' for f in filenames).encode('UTF-8')
+        ).split('\0')
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    # check-attr -z gives the path, attribute and value of each file
+    filtered = set(
+        filename for filename, value in zip(
+            attributes[0::3], attributes[2::3])
+        if value not in ('unspecified', 'unset'))
+    for filename, line in zip(filenames, sizes):
+        stored = line.split()
+        try:
+            size = os.stat(os.path.join(directory, filename)).st_size
+        except OSError:
+            size = None
+        if (filename in filtered or len(stored) != 3 or
+                stored[2] != str(size)):
+            del sha1s[filename]
+    return sha1s
+
+
+def stat_key(st):
+    """the stat fields that invalidate a cached sha1 when they change"""
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return [st.st_size, mtime_ns, st.st_ino]
+
+
+class ChecksumCache(object):
+    """an on-disk manifest of sha1s keyed by path and stat information
+
+    an entry is only trusted while the size, mtime and inode of the file
+    all match what was recorded when it was hashed"""
+
+    # a file modified this recently could change again without its mtime
+    # changing (coarse filesystem timestamps) so it is never cached
+    racy_seconds = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.dirty = False
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def get(self, filename, st):
+        entry = self.entries.get(filename)
+        if entry and entry[:3] == stat_key(st):
+            return entry[3]
+
+    def set(self, filename, st, sha1):
+        if time.time() - st.st_mtime < self.racy_seconds:
+            return
+        entry = stat_key(st) + [sha1]
+        if self.entries.get(filename) != entry:
+            self.entries[filename] = entry
+            self.dirty = True
+
+    def prune(self, filenames):
+        """forgets about files that are no longer in the directory"""
+        for filename in set(self.entries) - set(filenames):
+            del self.entries[filename]
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        temporary = '%s.%d' % (self.path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(temporary, 'w') as f:
+                json.dump(self.entries, f)
+            os.rename(temporary, self.path)
+            self.dirty = False
+        except (IOError, OSError) as e:
+            # a read-only home directory shouldn't stop a migration
+            logger.warning('unable to write checksum cache %s: %s',
+                           self.path, e)
@@ -1,19 +1,35 @@
 from mariposa.command import command
-from hashlib import sha1
 from optparse import OptionParser
 from datetime import datetime
-from glob import glob
-import subprocess
+import collections
+import io
 import logging
 import os
+import signal
 import sys
-from mariposa import dbengines
+import threading
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from mariposa import (
+    bundle, dbengines, fanout, plans, scanning, scheduler, tracing
+)
+from mariposa.checksums import (
+    ChecksumCache, blob_sha1, cache_path, directory_key, git_index_sha1s,
+    migrations_digest, stat_key
+)
 from mariposa.dbengines import FilenameSha1
 
 
 logger = logging.getLogger(__name__)
 
 
+# baselines written by squash aren't migrations themselves
+BASELINE_EXTENSION = '.baseline'
+
+
 class OutOfOrderException(Exception):
     pass
 
@@ -22,29 +38,343 @@ class ModifiedMigrationException(Exception):
     pass
 
 
+def reconcile_renames(performed_migrations, current_migrations):
+    """returns the (old filename, new filename) renames that make the
+    performed migrations match the current ones by sha1 along with the
+    (sha1, performed filenames, current filenames) that are ambiguous
+
+    a sha1 that was performed and is current under more than one name is
+    only renamed when a single filename changed"""
+    performed = collections.defaultdict(set)
+    current = collections.defaultdict(set)
+    for filename, sha1 in performed_migrations:
+        performed[sha1].add(filename)
+    for filename, sha1 in current_migrations:
+        current[sha1].add(filename)
+    renames = []
+    conflicts = []
+    for sha1 in sorted(set(performed).intersection(current)):
+        old = performed[sha1] - current[sha1]
+        new = current[sha1] - performed[sha1]
+        if not old or not new:
+            continue
+        if len(old) == 1 and len(new) == 1:
+            renames.append((old.pop(), new.pop()))
+        else:
+            conflicts.append((sha1, sorted(old), sorted(new)))
+    return renames, conflicts
+
+
+Pending = collections.namedtuple(
+    'Pending', 'to_run out_of_order modified deleted')
+
+
+def pending_migrations(current_migrations, performed_migrations):
+    """compares the current migrations with the performed ones
+
+    returns the migrations to run in filename order along with the
+    filenames to run that are older than the latest performed migration,
+    the ones that were modified and the ones that were deleted since they
+    were performed
+
+    both lists are walked side by side in a single pass. they normally come
+    in filename order already (the migration table is read ORDER BY
+    filename and the directory is scanned in filename order) which makes
+    sorting them linear and nothing but the result is built up"""
+    current = sorted(current_migrations)
+    performed = sorted(performed_migrations)
+    # usually everything that was performed is still current and the rest
+    # of the migrations are new
+    if current[:len(performed)] == performed and (
+            len(current) == len(performed) or not performed or
+            current[len(performed)].filename > performed[-1].filename):
+        return Pending(current[len(performed):], [], set(), set())
+    latest = performed[-1].filename if performed else None
+    to_run = []
+    out_of_order = []
+    modified = set()
+    deleted = set()
+    i = j = 0
+    n = len(current)
+    m = len(performed)
+    while i < n or j < m:
+        if i < n and j < m and current[i] == performed[j]:
+            i += 1
+            j += 1
+            continue
+        if j < m and (i == n or performed[j].filename < current[i].filename):
+            # unless it's another row for the migration before
+            if not i or performed[j].filename != current[i - 1].filename:
+                deleted.add(performed[j].filename)
+            j += 1
+            continue
+        filename = current[i].filename
+        performed_sha1s = ()
+        if j < m and performed[j].filename == filename:
+            performed_sha1s = []
+            while j < m and performed[j].filename == filename:
+                performed_sha1s.append(performed[j].sha1)
+                j += 1
+        while i < n and current[i].filename == filename:
+            if current[i].sha1 not in performed_sha1s:
+                to_run.append(current[i])
+                if performed_sha1s:
+                    modified.add(filename)
+                if latest is not None and filename < latest:
+                    out_of_order.append(filename)
+            i += 1
+    return Pending(to_run, out_of_order, modified, deleted)
+
+
 class DBMigrate(object):
     """A set of commands to safely migrate databases automatically"""
+    # threads used to hash migrations (None lets the executor decide)
+    hash_workers = None
+
     def __init__(self, out_of_order, dry_run, engine, connection_string,
-                 directory):
+                 directory, cache=True, verify_cache=False, git_index=False,
+                 batch=False, batch_size=0, migrations=None, trace=None,
+                 slow_threshold=None, explain=False, snapshot=None,
+                 connection=None, pool=None, script_timeout=None,
+                 lock_timeout=300, output=None, apply_plan=None, since=None,
+                 paths=None):
         self.out_of_order = out_of_order
         self.dry_run = dry_run
-        self.engine = getattr(dbengines, engine)(connection_string)
+        self.engine_name = engine
+        self.connection_string = connection_string
+        self._engine = None
         self.directory = directory
+        self.cache = cache
+        self.verify_cache = verify_cache
+        self.git_index = git_index
+        self.batch = batch
+        self.batch_size = batch_size
+        # precomputed current migrations shared by every target of a fan out
+        self.migrations = migrations
+        # more tracers can be appended to follow along with migrate
+        self.tracer = tracing.Tracers()
+        if trace:
+            self.tracer.append(tracing.JSONLinesTracer(trace))
+        self.slow_threshold = slow_threshold
+        self.explain = explain
+        # a file of the migrations performed as of the last migrate which
+        # lets status and plan skip connecting to the database
+        self.snapshot = snapshot
+        # an open DB-API connection or a pool (with getconn and putconn
+        # methods) to use instead of connecting with the connection string
+        self.connection = connection
+        self.pool = pool
+        # seconds a script migration may run for (None for no limit)
+        self.script_timeout = script_timeout
+        # seconds to wait for another node that is migrating the database
+        self.lock_timeout = lock_timeout
+        # a file dry runs are written to as they go instead of being
+        # returned
+        self.output = output
+        # a plan exported by plan that migrate performs instead of planning
+        self.apply_plan = apply_plan
+        # subdirectories of migrations older than this timestamp (or the
+        # latest performed migration when it is 'latest') aren't scanned
+        self.since = since
+        # where each migration found by the last scan is (shared along with
+        # precomputed migrations)
+        self.paths = {} if paths is None else paths
+
+    @property
+    def engine(self):
+        """the database engine which connects the first time it is used"""
+        if self._engine is None:
+            self._engine = self.connect()
+            if self.slow_threshold is not None:
+                self.tracer.append(tracing.SlowStatementTracer(
+                    self.slow_threshold, self.explain))
+        return self._engine
+
+    def close(self):
+        """closes the connection to the database (if one was made) and the
+        trace"""
+        try:
+            if self._engine is not None:
+                self._engine.close()
+                self._engine = None
+        finally:
+            self.tracer.close()
+
+    def connect(self):
+        """returns a new connection to the database"""
+        engine_class = getattr(dbengines, self.engine_name)
+        if self.pool is not None:
+            engine = engine_class.from_connection(
+                self.pool.getconn(), self.pool.putconn)
+        elif self.connection is not None:
+            engine = engine_class.from_connection(self.connection)
+            # there is only the one connection to go around
+            engine.parallel_workers = 1
+        else:
+            engine = engine_class(self.connection_string)
+        engine.tracer = self.tracer
+        return engine
 
     def blobsha1(self, filename):
         """returns the git sha1sum of a file so the exact migration
         that was run can easily be looked up in the git history"""
-        text = open(filename).read()
-        s = sha1(("blob %u\0" % len(text)).encode('UTF-8'))
-        s.update(text.encode('UTF-8'))
-        return s.hexdigest()
+        return blob_sha1(filename)
+
+    def hash_files(self, filenames):
+        """returns the blobsha1 of each file, hashing them across a thread
+        pool since hashlib releases the GIL while it works"""
+        if len(filenames) < 2:
+            return [self.blobsha1(filename) for filename in filenames]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(self.hash_workers) as executor:
+            return list(executor.map(self.blobsha1, filenames))
+
+    def migration_files(self, since=None):
+        """scans the directory and its subdirectories for migrations,
+        remembering the path of each one"""
+        found = scanning.scan(self.directory, since)
+        files = [
+            migration for migration in found.files
+            if not migration.filename.endswith(BASELINE_EXTENSION)]
+        self.paths.clear()
+        self.paths.update((f.filename, f.path) for f in files)
+        return found._replace(files=files)
+
+    def migration_path(self, filename):
+        """returns where a migration found by the last scan is"""
+        return self.paths.get(filename, os.path.join(self.directory, filename))
+
+    def watermark(self):
+        """returns the timestamp subdirectories of older migrations are
+        skipped below (None to scan everything)"""
+        if self.since != 'latest':
+            return self.since
+        if self.snapshot and os.path.exists(self.snapshot):
+            performed = self.performed_migrations()
+            return max(performed).filename if performed else None
+        try:
+            return self.engine.latest_migration()
+        except dbengines.SQLException:
+            return None
 
     def current_migrations(self):
         """returns the current migration files as a list of
-           (filename, sha1sum) tuples"""
-        return [
-            FilenameSha1(os.path.basename(filename), self.blobsha1(filename))
-            for filename in glob(os.path.join(self.directory, '*'))]
+           (filename, sha1sum) tuples in filename order"""
+        current_migrations, skipped = self.scanned_migrations()
+        return self.with_skipped(current_migrations, skipped)
+
+    def scanned_migrations(self):
+        """returns the current migrations that were scanned in filename
+        order and the timestamp prefixes of the subdirectories that were
+        skipped below the watermark"""
+        if self.migrations is not None:
+            return self.migrations, []
+        packed = bundle.load(self.directory)
+        if packed is not None:
+            # the bundle's index has the sha1s of everything in it
+            return [
+                FilenameSha1(filename, packed.sha1(filename))
+                for filename in packed.filenames()
+                if not filename.endswith(BASELINE_EXTENSION)], []
+        found = self.migration_files(self.watermark())
+        indexed = {}
+        if self.git_index:
+            indexed = git_index_sha1s(self.directory)
+        cache = None
+        if self.cache:
+            cache = ChecksumCache(cache_path(self.directory))
+        sha1s = {}
+        stats = {}
+        to_hash = []
+        for filename, path, st in found.files:
+            if indexed:
+                relative = os.path.relpath(path, self.directory)
+                if relative in indexed:
+                    sha1s[filename] = indexed[relative]
+                    continue
+            if cache is not None:
+                stats[filename] = st
+                sha1 = cache.get(filename, st)
+                if sha1 is not None:
+                    sha1s[filename] = sha1
+                    if not self.verify_cache:
+                        continue
+            to_hash.append(path)
+        for path, sha1 in zip(to_hash, self.hash_files(to_hash)):
+            filename = os.path.basename(path)
+            if sha1s.get(filename, sha1) != sha1:
+                self.warn('Cached sha1 for [%s] was stale.' % filename)
+            sha1s[filename] = sha1
+            if cache is not None:
+                cache.set(filename, stats[filename], sha1)
+        if cache is not None:
+            if not found.skipped:
+                cache.prune(stats)
+            cache.save()
+        return [FilenameSha1(f.filename, sha1s[f.filename])
+                for f in found.files], found.skipped
+
+    def with_skipped(self, current_migrations, skipped):
+        """returns the scanned migrations along with those in the
+        subdirectories that weren't scanned, which are taken to be the ones
+        that were performed"""
+        if not skipped:
+            return current_migrations
+        skipped = tuple(skipped)
+        return sorted(current_migrations + [
+            migration for migration in self.performed_migrations()
+            if migration.filename.startswith(skipped)])
+
+    def up_to_date(self, current_migrations, skipped):
+        """returns True when the performed migrations are the scanned ones
+        and whatever was performed in the skipped subdirectories
+
+        with skipped subdirectories only the performed migrations outside
+        of them are compared so the whole history isn't fetched"""
+        if skipped:
+            return self.engine.up_to_date_outside(
+                current_migrations, skipped)
+        return self.engine.up_to_date(current_migrations)
+
+    def performed_migrations(self):
+        """returns the performed migrations from the snapshot when there is
+        one, otherwise from the database (an empty list when it hasn't been
+        migrated yet)"""
+        if self.snapshot and os.path.exists(self.snapshot):
+            with open(self.snapshot) as f:
+                return [FilenameSha1(*m) for m in json.load(f)]
+        try:
+            return self.engine.performed_migrations()
+        except dbengines.SQLException:
+            return []
+
+    def save_snapshot(self, migrations):
+        """writes the performed migrations to the snapshot file"""
+        if not self.snapshot:
+            return
+        temporary = '%s.%d' % (self.snapshot, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump(sorted(migrations), f)
+        os.rename(temporary, self.snapshot)
+
+    def check(self, pending):
+        """raises an exception when the pending migrations can't be run"""
+        if pending.out_of_order:
+            if self.out_of_order:
+                self.warn('Running [%s] out of order.' %
+                          ','.join(pending.out_of_order))
+            else:
+                raise OutOfOrderException(
+                    '[%s] older than the latest performed migration' %
+                    ','.join(pending.out_of_order))
+        if pending.modified:
+            raise ModifiedMigrationException(
+                '[%s] migrations were modified since they were '
+                'run on this database.' % ','.join(sorted(pending.modified)))
+        if pending.deleted:
+            raise ModifiedMigrationException(
+                '[%s] migrations were deleted since they were '
+                'run on this database.' % ','.join(sorted(pending.deleted)))
 
     def warn(self, message):
         sys.stderr.write(message + "\n")
@@ -52,33 +382,126 @@ class DBMigrate(object):
     @command
     def renamed(self, *args):
         """rename files in the migration table if the order changed"""
-        performed_migrations = dict(
-            (v, k) for k, v in self.engine.performed_migrations())
-        current_migrations = dict(
-            (v, k) for k, v in self.current_migrations())
-        renames = []
-        for sha1, old_filename in performed_migrations.items():
-            new_filename = current_migrations.get(sha1)
-            if sha1 in current_migrations and old_filename != new_filename:
-                renames.append(FilenameSha1(new_filename, sha1))
-        sql = '\n'.join(
-            "UPDATE dbmigration SET filename = '%(filename)s' "
-            "WHERE sha1 = '%(sha1)s';" % rename._asdict()
-            for rename in renames)
+        renames, conflicts = reconcile_renames(
+            self.engine.performed_migrations(), self.current_migrations())
+        for sha1, performed, current in conflicts:
+            self.warn('Not renaming [%s] since the migrations with sha1 %s '
+                      'could be any of [%s].' % (
+                          ','.join(performed), sha1, ','.join(current)))
         if self.dry_run:
-            return sql
-        else:
-            self.engine.execute(sql)
+            return '\n'.join(
+                "UPDATE dbmigration SET filename = %s WHERE filename = %s;" %
+                (dbengines.quote(new), dbengines.quote(old))
+                for old, new in renames)
+        elif renames:
+            self.engine.rename_migrations(renames)
 
     @command
     def migrate(self, *args):
         """migrate a database to the current schema"""
+        if self.apply_plan:
+            return self.run_plan(plans.read(self.apply_plan))
+        start = time.time()
+        scanned, skipped = self.scanned_migrations()
+        if self.up_to_date(scanned, skipped):
+            if self.snapshot and not self.dry_run:
+                self.save_snapshot(self.with_skipped(scanned, skipped))
+            return
+        current_migrations = self.with_skipped(scanned, skipped)
+        if self.dry_run:
+            return self.run_migrations(start, current_migrations)
+        locked = self.engine.lock(self.lock_timeout)
+        try:
+            # another node may have migrated while this one waited
+            if self.up_to_date(scanned, skipped):
+                self.save_snapshot(current_migrations)
+                return
+            if not locked:
+                raise dbengines.LockTimeoutException(
+                    'Gave up waiting %s seconds for another node to finish '
+                    'migrating.' % self.lock_timeout)
+            return self.run_migrations(start, current_migrations)
+        finally:
+            if locked:
+                self.engine.unlock()
+
+    def verify_plan(self, migrations):
+        """raises an exception unless every migration in a plan is still
+        exactly what it was when the plan was made
+
+        only the migrations the plan runs are hashed. they are about to be
+        read anyway and checking them all first means nothing is run when
+        one of them has changed"""
+        packed = bundle.load(self.directory)
+        if packed is not None:
+            # the bundle checks each file against its index as it's read
+            sha1s = [packed.index.get(m.filename, [None])[0]
+                     for m in migrations]
+        else:
+            paths = [self.migration_path(m.filename) for m in migrations]
+            missing = [m.filename for m, path in zip(migrations, paths)
+                       if not os.path.isfile(path)]
+            if missing:
+                raise plans.PlanException(
+                    '[%s] in the plan no longer exist.' % ','.join(missing))
+            sha1s = self.hash_files(paths)
+        changed = [m.filename for m, sha1 in zip(migrations, sha1s)
+                   if sha1 != m.sha1]
+        if changed:
+            raise plans.PlanException(
+                '[%s] changed since the plan was made.' % ','.join(changed))
+
+    def run_plan(self, plan):
+        """performs the migrations in a plan without planning once the
+        database is found to be in the state it was planned for"""
+        migrations = [FilenameSha1(*m) for m in plan['migrations']]
+        if migrations and bundle.load(self.directory) is None:
+            # everything the plan runs is newer than what was performed
+            self.migration_files(migrations[0].filename)
+        self.verify_plan(migrations)
+        if self.dry_run:
+            plans.check(plan, self.performed_migrations())
+            return self.write_dry_run(
+                self.output or io.StringIO(), migrations)
+        locked = self.engine.lock(self.lock_timeout)
+        try:
+            try:
+                performed_migrations = self.engine.performed_migrations()
+            except dbengines.SQLException:
+                performed_migrations = []
+            result = plan['result']
+            if (len(performed_migrations) == result['migrations'] and
+                    migrations_digest(performed_migrations) ==
+                    result['digest']):
+                # another node applied the plan while this one waited
+                return
+            if not locked:
+                raise dbengines.LockTimeoutException(
+                    'Gave up waiting %s seconds for another node to finish '
+                    'migrating.' % self.lock_timeout)
+            plans.check(plan, performed_migrations)
+            try:
+                self.engine.create_migration_table()
+            except dbengines.SQLException:
+                self.engine.upgrade_migration_table()
+            self.perform(
+                migrations, [m.filename for m in performed_migrations])
+            performed_migrations = performed_migrations + migrations
+            self.engine.save_digest(performed_migrations)
+            self.save_snapshot(performed_migrations)
+        finally:
+            if locked:
+                self.engine.unlock()
+
+    def run_migrations(self, start, current_migrations):
+        """performs the migrations that haven't been performed yet (or
+        returns what would be performed on a dry run)"""
         if not self.dry_run:
             try:
                 self.engine.create_migration_table()
             except dbengines.SQLException:
                 # migration table has already been created
-                pass
+                self.engine.upgrade_migration_table()
         try:
             performed_migrations = self.engine.performed_migrations()
         except dbengines.SQLException as e:
@@ -87,51 +510,392 @@ class DBMigrate(object):
                 performed_migrations = []
             else:
                 raise e
+        out = self.output or io.StringIO()
+        if not performed_migrations:
+            baseline = self.baseline(current_migrations)
+            if baseline and self.dry_run:
+                self.write_migration(out, 'baseline: ', baseline)
+            elif baseline:
+                self.engine.run(baseline)
+            if baseline:
+                performed_migrations = baseline.replaces()
 
-        current_migrations = self.current_migrations()
-        files_current = [x.filename for x in current_migrations]
+        pending = pending_migrations(current_migrations, performed_migrations)
+        self.check(pending)
         files_performed = [x.filename for x in performed_migrations]
-        files_sha1s_to_run = (
-            set(current_migrations) - set(performed_migrations))
-        files_to_run = [x.filename for x in files_sha1s_to_run]
-        if len(files_performed):
-            latest_migration = max(files_performed)
-            old_unrun_migrations = list(filter(
-                lambda f: f < latest_migration, files_to_run))
-            if len(old_unrun_migrations):
-                if self.out_of_order:
-                    self.warn('Running [%s] out of order.' %
-                              ','.join(old_unrun_migrations))
-                else:
-                    raise OutOfOrderException(
-                        '[%s] older than the latest performed migration' %
-                        ','.join(old_unrun_migrations))
-        modified_migrations = set(files_to_run).intersection(files_performed)
-        if modified_migrations:
-            raise ModifiedMigrationException(
-                '[%s] migrations were modified since they were '
-                'run on this database.' % ','.join(modified_migrations))
-        deleted_migrations = (
-            set(files_performed + files_to_run) - set(files_current))
-        if deleted_migrations:
-            raise ModifiedMigrationException(
-                '[%s] migrations were deleted since they were '
-                'run on this database.' % ','.join(deleted_migrations))
-        command_sql = self.engine.sql(self.directory, files_sha1s_to_run)
+        files_sha1s_to_run = pending.to_run
+        if self.tracer:
+            self.tracer.plan_computed(
+                files_sha1s_to_run, time.time() - start)
         if self.dry_run:
-            response = []
-            for command, sql in command_sql:
+            return self.write_dry_run(out, files_sha1s_to_run)
+        self.perform(files_sha1s_to_run, files_performed)
+        # the performed migrations now match the current ones exactly
+        self.engine.save_digest(current_migrations)
+        self.save_snapshot(current_migrations)
+
+    def write_migration(self, out, prefix, migration):
+        """writes a migration a line at a time"""
+        lines = migration.lines()
+        out.write(prefix + next(lines))
+        for line in lines:
+            out.write('\n' + line)
+        out.write('\n')
+
+    def write_dry_run(self, out, files_sha1s_to_run):
+        """writes what would be run to output, returning it instead when
+        there isn't an output"""
+        for command, migration in self.engine.sql(
+                self.directory, files_sha1s_to_run, self.paths):
+            if command:
+                out.write('command: %s\n' % command)
+            self.write_migration(out, 'sql: ', migration)
+        if self.output is None:
+            return out.getvalue()[:-1]
+
+    def perform(self, files_sha1s_to_run, files_performed):
+        """runs migrations in filename order (or as their dependencies
+        allow)"""
+        command_sql = self.engine.sql(
+            self.directory, files_sha1s_to_run, self.paths)
+        self.engine.deploy = '%s@%s' % (
+            datetime.utcnow().strftime('%Y%m%d%H%M%S'),
+            dbengines.hostname())
+        if self.batch and self.engine.transactional_ddl:
+            self.run_batches(command_sql)
+        else:
+            command_sql = list(command_sql)
+            if self.engine.parallel_workers > 1 and any(
+                    migration.depends() is not None
+                    for command, migration in command_sql):
+                self.run_parallel(command_sql, files_performed)
+            else:
+                for command, migration in command_sql:
+                    if command:
+                        self.run_script(command, migration)
+                    else:
+                        self.engine.run(migration)
+
+    @command
+    def status(self, *args):
+        """list pending, modified and deleted migrations"""
+        current_migrations = self.current_migrations()
+        performed_migrations = self.performed_migrations()
+        pending = pending_migrations(current_migrations, performed_migrations)
+        if not (pending.to_run or pending.deleted):
+            return 'Up to date (%d migrations performed)' % len(
+                performed_migrations)
+        response = ['%d migrations performed, %d pending' % (
+            len(performed_migrations), len(pending.to_run))]
+        out_of_order = set(pending.out_of_order)
+        for filename, sha1 in pending.to_run:
+            if filename in pending.modified:
+                response.append('modified: %s' % filename)
+            elif filename in out_of_order:
+                response.append('out of order: %s' % filename)
+            else:
+                response.append('pending: %s' % filename)
+        for filename in sorted(pending.deleted):
+            response.append('deleted: %s' % filename)
+        return '\n'.join(response)
+
+    @command
+    def plan(self, export=None):
+        """list the migrations migrate would run in order (and write them
+        to export for migrate --apply-plan)"""
+        current_migrations = self.current_migrations()
+        performed_migrations = self.performed_migrations()
+        pending = pending_migrations(current_migrations, performed_migrations)
+        self.check(pending)
+        if export:
+            plans.write(export, plans.make(
+                performed_migrations, pending.to_run))
+        return '\n'.join('%s %s' % migration for migration in pending.to_run)
+
+    @command
+    def watch(self, interval=1, sleep=time.sleep):
+        """migrate as new migrations are added until interrupted"""
+        interval = float(interval)
+        self.migrate()
+        performed_migrations = set(self.engine.performed_migrations())
+        current = dict(self.current_migrations())
+        # files in subdirectories skipped by since get hashed on the first
+        # check since they aren't seen yet
+        seen = dict(
+            (f.filename, stat_key(f.stat))
+            for f in self.migration_files().files if f.filename in current)
+        try:
+            while True:
+                sleep(interval)
+                stats = dict(
+                    (f.filename, stat_key(f.stat))
+                    for f in self.migration_files().files)
+                if stats == seen:
+                    continue
+                changed = sorted(
+                    filename for filename in stats
+                    if stats[filename] != seen.get(filename))
+                sha1s = self.hash_files(
+                    [self.migration_path(f) for f in changed])
+                current = dict(
+                    (filename, current[filename]) for filename in stats
+                    if filename in current)
+                current.update(zip(changed, sha1s))
+                seen = stats
+                self.apply_new(
+                    [FilenameSha1(f, sha1) for f, sha1 in current.items()],
+                    performed_migrations)
+        except KeyboardInterrupt:
+            return
+
+    def apply_new(self, current_migrations, performed_migrations):
+        """runs the pending migrations for watch and adds them to the set of
+        performed migrations, warning instead of raising so it can carry on
+        once the problem is fixed"""
+        pending = pending_migrations(current_migrations, performed_migrations)
+        try:
+            self.check(pending)
+        except (OutOfOrderException, ModifiedMigrationException) as e:
+            self.warn(str(e))
+            return
+        self.engine.deploy = '%s@%s' % (
+            datetime.utcnow().strftime('%Y%m%d%H%M%S'), dbengines.hostname())
+        for command, migration in self.engine.sql(
+                self.directory, pending.to_run, self.paths):
+            try:
                 if command:
-                    response.append('command: ' + command)
-                if sql:
-                    response.append('sql: ' + sql)
-            return '\n'.join(response)
+                    self.run_script(command, migration)
+                else:
+                    self.engine.run(migration)
+            except Exception as e:
+                self.warn('[%s] failed: %s' % (migration.filename, e))
+                return
+            performed_migrations.add(
+                FilenameSha1(migration.filename, migration.sha1))
+            sys.stdout.write('Performed %s\n' % migration.filename)
+            sys.stdout.flush()
+        self.engine.save_digest(current_migrations)
+        self.save_snapshot(current_migrations)
+
+    def baseline(self, current_migrations):
+        """returns the baseline replacing the most migrations that are all
+        still current or None if there isn't one"""
+        current_migrations = set(current_migrations)
+        baselines = []
+        packed = bundle.load(self.directory)
+        if packed is not None:
+            filenames = [
+                os.path.join(self.directory, filename)
+                for filename in packed.filenames()
+                if filename.endswith(BASELINE_EXTENSION)]
         else:
-            for command, sql in command_sql:
+            filenames = [
+                f.path for f in scanning.scan(self.directory).files
+                if f.filename.endswith(BASELINE_EXTENSION)]
+        for filename in filenames:
+            baseline = dbengines.BaselineMigration(self.engine, filename)
+            if baseline.engine_name() != self.engine_name:
+                self.warn('Ignoring [%s] since it was written by %s.' % (
+                    baseline.filename, baseline.engine_name()))
+                continue
+            replaces = baseline.replaces()
+            if current_migrations.issuperset(replaces):
+                baselines.append((len(replaces), filename, baseline))
+            else:
+                self.warn('Ignoring [%s] since the migrations it replaces '
+                          'have changed.' % baseline.filename)
+        if baselines:
+            return max(baselines)[-1]
+
+    @command
+    def squash(self, cutoff=None):
+        """write a baseline replacing the migrations up to cutoff"""
+        engine_class = getattr(dbengines, self.engine_name)
+        if engine_class.scratch_connection_string is None:
+            raise dbengines.SQLException(
+                'squash is not supported for %s' % self.engine_name)
+        replaces = sorted(
+            migration for migration in self.current_migrations()
+            if cutoff is None or migration.filename <= cutoff)
+        if not replaces:
+            return 'Nothing to squash'
+        for filename, sha1 in replaces:
+            path = self.migration_path(filename)
+            if dbengines.migration_type(path) is None:
+                # a script would run against whatever database it likes
+                raise dbengines.MigrationFormatException(
+                    'Unable to squash the script [%s]' % filename)
+        filename = os.path.join(
+            self.directory,
+            os.path.splitext(replaces[-1].filename)[0] + BASELINE_EXTENSION)
+        if self.dry_run:
+            return 'Would create %s replacing %d migrations' % (
+                filename, len(replaces))
+        scratch = DBMigrate(
+            out_of_order=False, dry_run=False, engine=self.engine_name,
+            connection_string=engine_class.scratch_connection_string,
+            directory=self.directory, migrations=replaces, paths=self.paths)
+        scratch.migrate()
+        with open(filename, 'w') as f:
+            f.write('-- baseline written by mariposa squash\n')
+            f.write('-- engine: %s\n' % self.engine_name)
+            for migration in replaces:
+                f.write('-- replaces: %s %s\n' % migration)
+            for statement in scratch.engine.dump():
+                f.write(statement + '\n')
+
+    @command
+    def bundle(self, output):
+        """pack the migrations into a single file that -d accepts"""
+        files = scanning.scan(self.directory).files
+        if self.dry_run:
+            return 'Would bundle %d files into %s' % (len(files), output)
+        bundle.write(output, [(f.filename, f.path) for f in files])
+
+    @command
+    def provision(self, *targets):
+        """create databases by cloning a template of the current schema"""
+        migrations = self.current_migrations()
+        key = migrations_digest(migrations)[:16]
+        if self.dry_run:
+            return '\n'.join(
+                'Would provision %s' % target for target in targets)
+
+        def build(connection_string):
+            template = DBMigrate(
+                out_of_order=self.out_of_order, dry_run=False,
+                engine=self.engine_name, connection_string=connection_string,
+                directory=self.directory, migrations=migrations,
+                paths=self.paths)
+            template.migrate()
+            template.engine.close()
+        template = self.engine.build_template(
+            key, build, directory_key(self.directory))
+        for target in targets:
+            self.engine.clone_template(template, target)
+
+    def run_script(self, command, migration, engine=None):
+        """runs a script and records it once it succeeds
+
+        the output of the script is passed along a line at a time with the
+        filename in front of it and the script is killed if it takes longer
+        than script_timeout seconds"""
+        import subprocess
+        migration.started = datetime.utcnow()
+        # the script gets a process group of its own so anything it
+        # started is killed along with it
+        with bundle.extracted(command) as path:
+            process = subprocess.Popen(
+                path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                start_new_session=True)
+            self.wait_for_script(process, migration)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        (engine or self.engine).run(migration)
+
+    def wait_for_script(self, process, migration):
+        import subprocess
+        output = threading.Thread(
+            target=self.stream_output, args=(process.stdout, migration))
+        output.daemon = True
+        output.start()
+        try:
+            process.wait(self.script_timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            raise
+        finally:
+            # something the script left running in the background can keep
+            # the output open after it exits
+            output.join(1)
+            if not output.is_alive():
+                process.stdout.close()
+
+    def stream_output(self, output, migration):
+        for line in iter(output.readline, b''):
+            sys.stdout.write('[%s] %s' % (
+                migration.filename, line.decode('UTF-8', 'replace')))
+            sys.stdout.flush()
+
+    def run_parallel(self, command_sql, files_performed):
+        """runs each migration as soon as the migrations it depends on have
+        been performed, using a connection per worker"""
+        commands = dict((migration.filename, command)
+                        for command, migration in command_sql)
+        migrations = [migration for command, migration in command_sql]
+        graph = scheduler.dependencies(migrations, set(files_performed))
+        local = threading.local()
+        engines = []
+
+        def run(migration):
+            if not hasattr(local, 'engine'):
+                local.engine = self.connect()
+                local.engine.deploy = self.engine.deploy
+                engines.append(local.engine)
+            migration.engine = local.engine
+            command = commands[migration.filename]
+            if command:
+                self.run_script(command, migration, local.engine)
+            else:
+                local.engine.run(migration)
+        try:
+            scheduler.run_graph(
+                migrations, graph, run, self.engine.parallel_workers)
+        finally:
+            for engine in engines:
+                engine.close()
+
+    def run_batches(self, command_sql):
+        """runs consecutive SQL migrations in shared transactions of up to
+        batch_size migrations (unlimited when it is 0)
+
+        a script is never part of a batch since it can't be rolled back and
+        neither is a backfill since it commits as it goes"""
+        batch = []
+        for command, migration in command_sql:
+            if command or not migration.batchable:
+                if batch:
+                    self.engine.run_batch(batch)
+                    batch = []
                 if command:
-                    subprocess.check_call(command)
-                if sql:
-                    self.engine.execute(sql)
+                    self.run_script(command, migration)
+                else:
+                    self.engine.run(migration)
+                continue
+            batch.append(migration)
+            if self.batch_size and len(batch) >= self.batch_size:
+                self.engine.run_batch(batch)
+                batch = []
+        if batch:
+            self.engine.run_batch(batch)
+
+    @command
+    def stats(self, limit=10):
+        """list the slowest migrations and the time spent on each deploy"""
+        limit = int(limit)
+        try:
+            slowest = self.engine.results(
+                "SELECT filename, duration_ms, rows_affected, host, "
+                "started_at FROM dbmigration WHERE duration_ms IS NOT NULL "
+                "ORDER BY duration_ms DESC LIMIT %d" % limit)
+            deploys = self.engine.results(
+                "SELECT deploy, MIN(started_at), COUNT(*), SUM(duration_ms) "
+                "FROM dbmigration WHERE deploy IS NOT NULL GROUP BY deploy "
+                "ORDER BY MIN(started_at) DESC LIMIT %d" % limit)
+        except dbengines.SQLException:
+            return 'No migration timings have been recorded.'
+        response = ['Slowest migrations:']
+        for filename, duration_ms, rows_affected, host, started_at in slowest:
+            response.append('%10d ms  %s (%s rows on %s at %s)' % (
+                duration_ms, filename,
+                '?' if rows_affected is None else rows_affected,
+                host, started_at))
+        response.append('Deploys:')
+        for deploy, started_at, count, duration_ms in deploys:
+            response.append('%10d ms  %s (%d migrations started at %s)' % (
+                duration_ms, deploy, count, started_at))
+        return '\n'.join(response)
 
     @command
     def create(self, slug, ext="sql", open=open):
@@ -142,13 +906,18 @@ class DBMigrate(object):
                                 (dstring, slug, ext))
         if self.dry_run:
             return 'Would create %s' % filename
+        elif ext == 'py':
+            open(filename, 'w').write(
+                'def migrate(connection):\n'
+                '    cursor = connection.cursor()\n'
+                '    # add your migration here\n')
         else:
             open(filename, 'w').write('-- add your migration here')
 
 
 def main():
     usage = '\n'
-    for command_name, help in sorted(command.help.iteritems()):
+    for command_name, help in sorted(command.help.items()):
         usage += "%s - %s\n" % (command_name.rjust(15), help)
 
     parser = OptionParser(usage=usage)
@@ -176,6 +945,80 @@ def main():
         help="directory where the migrations are stored",
         type="string",
         default=".")
+    parser.add_option(
+        "--no-cache", dest="cache", action="store_false",
+        help="always hash every migration instead of using the cached sha1s",
+        default=True)
+    parser.add_option(
+        "--verify-cache", dest="verify_cache", action="store_true",
+        help="rehash every migration and warn about stale cached sha1s",
+        default=False)
+    parser.add_option(
+        "-g", "--git-index", dest="git_index", action="store_true",
+        help="read the sha1s of unmodified migrations from the git index",
+        default=False)
+    parser.add_option(
+        "-b", "--batch", dest="batch", action="store_true",
+        help="run consecutive SQL migrations in a single transaction",
+        default=False)
+    parser.add_option(
+        "--batch-size", dest="batch_size", action="store",
+        help="most migrations to run in a single transaction with --batch "
+             "(0 for no limit)",
+        type="int",
+        default=0)
+    parser.add_option(
+        "-t", "--target", dest="targets", action="append",
+        help="run against this connection string instead (may be repeated; "
+             "@file reads one per line and sqlite accepts globs)",
+        type="string",
+        default=[])
+    parser.add_option(
+        "-j", "--jobs", dest="jobs", action="store",
+        help="targets to migrate at the same time",
+        type="int",
+        default=4)
+    parser.add_option(
+        "--trace", dest="trace", action="store",
+        help="append a JSON line for every file and statement to this file",
+        type="string")
+    parser.add_option(
+        "--slow-threshold", dest="slow_threshold", action="store",
+        help="log statements that take longer than this many seconds",
+        type="float")
+    parser.add_option(
+        "--explain", dest="explain", action="store_true",
+        help="log the query plan of slow statements (postgres and sqlite)",
+        default=False)
+    parser.add_option(
+        "--lock-timeout", dest="lock_timeout", action="store",
+        help="seconds to wait for another node that is migrating the "
+             "database (300 by default)",
+        type="float",
+        default=300)
+    parser.add_option(
+        "--script-timeout", dest="script_timeout", action="store",
+        help="kill script migrations that run for more than this many "
+             "seconds",
+        type="float")
+    parser.add_option(
+        "--since", dest="since", action="store",
+        help="skip subdirectories (such as 2012/01) of migrations older "
+             "than this timestamp or the latest performed migration with "
+             "'latest'")
+    parser.add_option(
+        "--output", dest="output", action="store",
+        help="write a dry run to this file as it goes instead of stdout",
+        type="string")
+    parser.add_option(
+        "--apply-plan", dest="apply_plan", action="store",
+        help="perform a plan written by plan instead of planning",
+        type="string")
+    parser.add_option(
+        "--snapshot", dest="snapshot", action="store",
+        help="file migrate records the performed migrations in so status "
+             "and plan can run without connecting to the database",
+        type="string")
 
     (options, args) = parser.parse_args()
 
@@ -187,8 +1030,29 @@ def main():
             'DBMIGRATE_ENGINE', options['engine'])
         options['connection_string'] = os.environ.get(
             'DBMIGRATE_CONNECTION', options['connection_string'])
-        mariposa = DBMigrate(**options)
-        result = command.commands[args[0]](mariposa, *args[1:])
+        targets = options.pop('targets')
+        jobs = options.pop('jobs')
+        output = options.pop('output')
+        if targets:
+            start = time.time()
+            results = fanout.fan_out(
+                DBMigrate, options,
+                fanout.expand_targets(options['engine'], targets),
+                command.commands[args[0]], args[1:], jobs)
+            print(fanout.summary(results, time.time() - start))
+            if not all(result.succeeded for result in results):
+                sys.exit(1)
+            return
+        if output:
+            options['output'] = open(output, 'w')
+        elif options['dry_run']:
+            options['output'] = sys.stdout
+        try:
+            mariposa = DBMigrate(**options)
+            result = command.commands[args[0]](mariposa, *args[1:])
+        finally:
+            if output:
+                options['output'].close()
         if result:
             print(result)
 
@@ -1,7 +1,16 @@
 import collections
+import csv
+import datetime
+import hashlib
+import itertools
 import logging
-import sqlite3
+import re
 import os
+import sys
+import time
+from mariposa.bundle import open_migration
+from mariposa.checksums import cache_directory, migrations_digest
+from mariposa.sqlsplit import split_statements
 try:
     import json
 except ImportError:
@@ -10,6 +19,21 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+_hostname = None
+
+
+def hostname():
+    """returns the name of this node, which is recorded with each migration
+    so slow ones can be traced back to it
+
+    it is looked up the first time it's needed since resolving it slows
+    down commands that never record a migration"""
+    global _hostname
+    if _hostname is None:
+        import socket
+        _hostname = socket.gethostname()
+    return _hostname
+
 
 loads_string_keys = lambda s: dict(
     (str(k), v) for k, v in json.loads(s).items()
@@ -20,57 +44,1032 @@ class SQLException(Exception):
     pass
 
 
+class MigrationFormatException(Exception):
+    pass
+
+
+class LockTimeoutException(SQLException):
+    pass
+
+
 FilenameSha1 = collections.namedtuple('FilenameSha1', 'filename sha1')
 
 
+def abandoned(host, pid):
+    """whether a lock was taken by a process on this host that has exited"""
+    if host != hostname():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        # it exists but belongs to someone else
+        pass
+    return False
+
+
+def quote(value):
+    """returns value as an SQL literal"""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, int):
+        return str(value)
+    return "'%s'" % str(value).replace("'", "''")
+
+
+class Migration(object):
+    """the SQL for a migration which is only read from disk as it is
+    executed or printed
+
+    path is None for scripts which only need their dbmigration record"""
+
+    # whether the statements can be sent to the server in batches
+    pipelined = True
+    # whether the migration can share a transaction with others
+    batchable = True
+
+    depends_comment = re.compile(r'--\s*depends:\s*(.*?)\s*$')
+
+    def __init__(self, engine, filename, sha1, path=None):
+        self.engine = engine
+        self.filename = filename
+        self.sha1 = sha1
+        self.path = path
+        # set by whatever runs a script before this migration is applied
+        self.started = None
+
+    def header(self):
+        return '-- start filename: %s sha1: %s' % (self.filename, self.sha1)
+
+    def record(self, started=None, rows_affected=None):
+        """returns the statement that records the migration in dbmigration
+        along with how long it took when it was started"""
+        if started is None:
+            return (
+                "INSERT INTO dbmigration (filename, sha1, date) "
+                "VALUES ('%s', '%s', %s());" %
+                (self.filename, self.sha1, self.engine.date_func))
+        duration = datetime.datetime.utcnow() - started
+        return (
+            "INSERT INTO dbmigration (filename, sha1, date, started_at, "
+            "duration_ms, rows_affected, host, deploy) "
+            "VALUES (%s, %s, %s(), %s, %s, %s, %s, %s);" % (
+                quote(self.filename), quote(self.sha1), self.engine.date_func,
+                quote(started.strftime('%Y-%m-%d %H:%M:%S')),
+                quote(int(duration.total_seconds() * 1000)),
+                quote(rows_affected), quote(hostname()),
+                quote(self.engine.deploy)))
+
+    def body(self):
+        if self.path is None:
+            return
+        with open_migration(self.path) as f:
+            for line in f:
+                yield line.rstrip('\n')
+
+    @classmethod
+    def handles(cls, path):
+        """whether the file at path is a migration of this type"""
+        return True
+
+    def depends(self):
+        """returns the filenames named by "-- depends: filename" comments at
+        the top of the migration or None if it doesn't have any"""
+        if self.path is None:
+            return None
+        depends = None
+        for line in self.body():
+            if not line.strip():
+                continue
+            if not line.lstrip().startswith('--'):
+                break
+            match = self.depends_comment.match(line.strip())
+            if match:
+                depends = (depends or []) + [
+                    f for f in re.split(r'[\s,]+', match.group(1)) if f]
+        return depends
+
+    def lines(self):
+        yield self.header()
+        for line in self.body():
+            yield line
+        yield self.record()
+
+    def statements(self):
+        """yields the statements of the migration one at a time"""
+        lines = itertools.chain([self.header()], self.body())
+        return split_statements(lines, self.engine.dialect)
+
+    def apply(self, cursor):
+        """performs the migration, letting the engine's tracer know"""
+        tracer = self.engine.tracer
+        if not tracer:
+            return self.perform(cursor)
+        tracer.file_started(self)
+        start = time.time()
+        try:
+            self.perform(cursor)
+        except Exception as e:
+            tracer.file_finished(self, time.time() - start, e)
+            raise
+        tracer.file_finished(self, time.time() - start)
+
+    def execute(self, cursor, statement, parameters=None):
+        arguments = (statement,) if parameters is None else (
+            statement, parameters)
+        tracer = self.engine.tracer
+        if not tracer:
+            return cursor.execute(*arguments)
+        tracer.statement_started(self, statement)
+        start = time.time()
+        try:
+            cursor.execute(*arguments)
+        except Exception as e:
+            tracer.statement_finished(
+                self, statement, time.time() - start, cursor, e)
+            raise
+        tracer.statement_finished(self, statement, time.time() - start, cursor)
+
+    def perform(self, cursor):
+        started = self.started or datetime.datetime.utcnow()
+        rows_affected = 0
+        for statement in self.statements():
+            self.execute(cursor, statement)
+            rows_affected += max(cursor.rowcount, 0)
+        if self.path is None:
+            # whatever a script did isn't visible to this connection
+            rows_affected = None
+        cursor.execute(self.record(started, rows_affected))
+
+    def __str__(self):
+        return '\n'.join(self.lines())
+
+
+class BulkLoadMigration(Migration):
+    """a .csv migration loaded with the fastest bulk loader of the engine
+
+    the file starts with a "-- table: name" comment and optionally a
+    "-- columns: a, b" comment. without the columns comment the first row
+    of the CSV names the columns"""
+
+    pipelined = False
+
+    header_comment = re.compile(r'--\s*(table|columns)\s*:\s*(.*?)\s*$')
+
+    def open(self):
+        """returns the table, the columns and the file positioned at the
+        first row of data"""
+        f = open_migration(self.path, newline='')
+        try:
+            options = {}
+            while True:
+                position = f.tell()
+                line = f.readline()
+                match = self.header_comment.match(line)
+                if not match:
+                    break
+                options[match.group(1)] = match.group(2)
+            f.seek(position)
+            if not options.get('table'):
+                raise MigrationFormatException(
+                    '%s has no "-- table:" header' % self.filename)
+            if options.get('columns'):
+                columns = [c.strip() for c in options['columns'].split(',')]
+            else:
+                columns = next(csv.reader([f.readline()]))
+            return options['table'], columns, f
+        except Exception:
+            f.close()
+            raise
+
+    def depends(self):
+        return None
+
+    def perform(self, cursor):
+        started = datetime.datetime.utcnow()
+        table, columns, f = self.open()
+        with f:
+            rows_affected = self.engine.bulk_load(cursor, table, columns, f)
+        cursor.execute(self.record(started, rows_affected))
+
+
+class BaselineMigration(Migration):
+    """a snapshot of the schema and data left by a series of migrations that
+    is applied to empty databases instead of them
+
+    the migrations it replaces are listed at the top of the file as
+    "-- replaces: filename sha1" comments and are recorded in dbmigration
+    along with it"""
+
+    pipelined = False
+
+    replaces_comment = re.compile(r'--\s*replaces:\s*(\S+)\s+(\S+)\s*$')
+    engine_comment = re.compile(r'--\s*engine:\s*(\S+)\s*$')
+
+    def __init__(self, engine, path):
+        super(BaselineMigration, self).__init__(
+            engine, os.path.basename(path), None, path)
+
+    def header(self):
+        return '-- start baseline: %s' % self.filename
+
+    def comments(self):
+        """returns the comments at the top of the baseline"""
+        comments = []
+        with open_migration(self.path) as f:
+            for line in f:
+                if not line.startswith('--'):
+                    break
+                comments.append(line)
+        return comments
+
+    def replaces(self):
+        """returns the migrations the baseline stands in for"""
+        return [
+            FilenameSha1(*match.groups())
+            for match in map(self.replaces_comment.match, self.comments())
+            if match]
+
+    def engine_name(self):
+        """returns the name of the engine the baseline was dumped from
+
+        baselines written before the engine was recorded could only have
+        come from sqlite"""
+        for line in self.comments():
+            match = self.engine_comment.match(line)
+            if match:
+                return match.group(1)
+        return 'sqlite'
+
+    def perform(self, cursor):
+        started = datetime.datetime.utcnow()
+        for statement in self.statements():
+            self.execute(cursor, statement)
+        for filename, sha1 in self.replaces():
+            cursor.execute(Migration(self.engine, filename, sha1).record(
+                started, None))
+
+    def lines(self):
+        yield self.header()
+        for line in self.body():
+            yield line
+
+
+class Statements(object):
+    """statements that are run in a transaction the way migrations are"""
+
+    pipelined = False
+
+    def __init__(self, statements):
+        self.statements = statements
+
+    def apply(self, cursor):
+        for statement in self.statements:
+            cursor.execute(statement)
+
+
+class ExecuteMany(object):
+    """a parameterized statement run for every row in a transaction"""
+
+    pipelined = False
+
+    def __init__(self, engine, statement, rows):
+        self.engine = engine
+        self.statement = statement
+        self.rows = rows
+
+    def apply(self, cursor):
+        self.engine.executemany(cursor, self.statement, self.rows)
+
+
+class PythonMigration(Migration):
+    """a .py migration with a migrate(connection) function which is called
+    with the engine's connection in the transaction that records it
+
+    .py files without one are run as scripts like they always have been"""
+
+    pipelined = False
+
+    entry_point = re.compile(r'^def migrate\(', re.MULTILINE)
+
+    @classmethod
+    def handles(cls, path):
+        with open_migration(path) as f:
+            return cls.entry_point.search(f.read()) is not None
+
+    def depends(self):
+        return None
+
+    def lines(self):
+        yield self.header()
+        yield '-- migrate(connection) from %s' % self.path
+        yield self.record()
+
+    def load(self):
+        """imports the migration as a module of its own"""
+        import types
+        module = types.ModuleType('mariposa_migration_%s' % self.sha1)
+        module.__file__ = self.path
+        with open_migration(self.path) as f:
+            source = f.read()
+        exec(compile(source, self.path, 'exec'), module.__dict__)
+        return module
+
+    def perform(self, cursor):
+        started = self.started or datetime.datetime.utcnow()
+        self.load().migrate(self.engine.connection)
+        cursor.execute(self.record(started))
+
+
+class BackfillMigration(Migration):
+    """a .backfill migration that runs a statement over a table a batch of
+    keys at a time, committing after every batch
+
+    the file starts with "-- table: name" and "-- key: column" comments,
+    optionally followed by "-- batch-size: rows" and "-- pause: seconds" or
+    "-- rows-per-second: rows" comments to throttle it. the statement uses
+    :start and :end for the first and last key of each batch. the last key
+    of every batch is saved in dbmigration_progress so an interrupted
+    backfill carries on where it left off and it is only recorded in
+    dbmigration once the whole table has been done"""
+
+    pipelined = False
+    batchable = False
+    batch_size = 1000
+
+    header_comment = re.compile(
+        r'--\s*(table|key|batch-size|pause|rows-per-second)\s*:\s*(.*?)\s*$')
+    bound = re.compile(r'(?<!:):(start|end)\b')
+
+    def depends(self):
+        return None
+
+    def parse(self):
+        """returns the options in the header and the statement"""
+        options = {}
+        lines = []
+        for line in self.body():
+            match = self.header_comment.match(line)
+            if match and not lines:
+                options[match.group(1)] = match.group(2)
+            else:
+                lines.append(line)
+        for name in ('table', 'key'):
+            if not options.get(name):
+                raise MigrationFormatException(
+                    '%s has no "-- %s:" header' % (self.filename, name))
+        statements = list(split_statements(lines, self.engine.dialect))
+        if len(statements) != 1:
+            raise MigrationFormatException(
+                '%s must have exactly one statement' % self.filename)
+        return options, statements[0]
+
+    def checkpoint(self, cursor):
+        """returns the last key and the rows affected so far by an earlier
+        run of this version of the backfill"""
+        placeholder = self.engine.placeholder
+        cursor.execute(
+            'SELECT last_key, rows_affected FROM dbmigration_progress '
+            'WHERE filename = %s AND sha1 = %s' % (placeholder, placeholder),
+            (self.filename, self.sha1))
+        row = cursor.fetchone()
+        if row is None:
+            return None, 0
+        return json.loads(row[0]), row[1]
+
+    def save_checkpoint(self, cursor, last, rows_affected):
+        placeholder = self.engine.placeholder
+        cursor.execute(
+            'DELETE FROM dbmigration_progress WHERE filename = %s' %
+            placeholder, (self.filename,))
+        cursor.execute(
+            'INSERT INTO dbmigration_progress '
+            '(filename, sha1, last_key, rows_affected) '
+            'VALUES (%s, %s, %s, %s)' % ((placeholder,) * 4),
+            (self.filename, self.sha1, json.dumps(last, default=str),
+             rows_affected))
+
+    def next_batch(self, cursor, table, key, last, batch_size):
+        """returns the first and last key of the batch after last"""
+        placeholder = self.engine.placeholder
+        if last is None:
+            cursor.execute('SELECT MIN(%s) FROM %s' % (key, table))
+        else:
+            cursor.execute('SELECT MIN(%s) FROM %s WHERE %s > %s' % (
+                key, table, key, placeholder), (last,))
+        first = cursor.fetchone()[0]
+        if first is None:
+            return None, None
+        cursor.execute(
+            'SELECT %s FROM %s WHERE %s >= %s ORDER BY %s LIMIT 1 OFFSET %d' %
+            (key, table, key, placeholder, key, batch_size - 1), (first,))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute('SELECT MAX(%s) FROM %s WHERE %s >= %s' % (
+                key, table, key, placeholder), (first,))
+            row = cursor.fetchone()
+        return first, row[0]
+
+    def perform(self, cursor):
+        started = self.started or datetime.datetime.utcnow()
+        options, statement = self.parse()
+        batch_size = int(options.get('batch-size', self.batch_size))
+        pause = float(options.get('pause', 0))
+        rows_per_second = float(options.get('rows-per-second', 0))
+        bounds = self.bound.findall(statement)
+        statement = self.bound.sub(self.engine.placeholder, statement)
+        last, rows_affected = self.checkpoint(cursor)
+        while True:
+            batch_started = time.time()
+            first, last_in_batch = self.next_batch(
+                cursor, options['table'], options['key'], last, batch_size)
+            if first is None:
+                break
+            self.execute(cursor, statement, [
+                first if bound == 'start' else last_in_batch
+                for bound in bounds])
+            rows = max(cursor.rowcount, 0)
+            rows_affected += rows
+            last = last_in_batch
+            self.save_checkpoint(cursor, last, rows_affected)
+            self.engine.refresh_lock(cursor)
+            self.engine.connection.commit()
+            wait = pause
+            if rows_per_second:
+                wait = max(wait, rows / rows_per_second -
+                           (time.time() - batch_started))
+            if wait > 0:
+                time.sleep(wait)
+        cursor.execute(
+            'DELETE FROM dbmigration_progress WHERE filename = %s' %
+            self.engine.placeholder, (self.filename,))
+        cursor.execute(self.record(started, rows_affected))
+
+
+migration_types = {
+    '.sql': Migration,
+    '.csv': BulkLoadMigration,
+    '.py': PythonMigration,
+    '.backfill': BackfillMigration,
+}
+
+
+def migration_type(path):
+    """returns the class of the migration at path or None when it is a
+    script that has to be run on its own"""
+    migration_class = migration_types.get(os.path.splitext(path)[-1])
+    if migration_class is not None and migration_class.handles(path):
+        return migration_class
+
+
 class DatabaseMigrationEngine(object):
-    migration_table_sql = (
-        "CREATE TABLE dbmigration "
-        "(filename varchar(255), sha1 varchar(40), date datetime);")
+    dialect = None
+    # connections used to run independent migrations at the same time
+    parallel_workers = 4
+    # where squash can build a throwaway copy of the schema (if anywhere)
+    scratch_connection_string = None
+    # whether DDL can be rolled back so migrations can share a transaction
+    transactional_ddl = True
+    placeholder = '%s'
+    # rows sent to executemany at once when bulk loading
+    bulk_batch_size = 1000
+    migration_table_columns = (
+        ('filename', 'varchar(255)'),
+        ('sha1', 'varchar(40)'),
+        ('date', 'datetime'),
+        ('started_at', 'datetime'),
+        ('duration_ms', 'integer'),
+        ('rows_affected', 'integer'),
+        ('host', 'varchar(255)'),
+        ('deploy', 'varchar(255)'),
+    )
+    migration_table_indexes = (
+        ('dbmigration_filename', 'UNIQUE INDEX', 'filename'),
+        ('dbmigration_sha1', 'INDEX', 'sha1'),
+    )
+    # identifies the migrate run that performed a migration
+    deploy = None
+    # a mariposa.tracing.Tracer told about every file and statement
+    tracer = None
+    # called with the connection by close instead of closing it
+    release = None
+
+    @classmethod
+    def from_connection(cls, connection, release=None):
+        """returns an engine that uses a DB-API connection which is already
+        open. the connection is left open by close unless release closes it
+        """
+        engine = cls.__new__(cls)
+        engine.use_connection(connection)
+        engine.release = release or (lambda connection: None)
+        return engine
+
+    def use_connection(self, connection):
+        self.connection = connection
 
     def create_migration_table(self):
-        self.execute(self.migration_table_sql)
+        self.execute('CREATE TABLE dbmigration (%s);' % ', '.join(
+            '%s %s' % column for column in self.migration_table_columns))
+        self.upgrade_migration_table()
+
+    def upgrade_migration_table(self):
+        """adds the columns, indexes, digest and progress tables that a
+        migration table made by an older version of mariposa is missing"""
+        existing = set(
+            column.lower() for column in self.columns('dbmigration'))
+        for name, column_type in self.migration_table_columns:
+            if name not in existing:
+                self.execute('ALTER TABLE dbmigration ADD COLUMN %s %s;' % (
+                    name, column_type))
+        existing = set(name.lower() for name in self.index_names())
+        for name, index_type, column in self.migration_table_indexes:
+            if name in existing:
+                continue
+            try:
+                self.execute('CREATE %s %s ON dbmigration (%s);' % (
+                    index_type, name, column))
+            except SQLException as e:
+                # most likely a filename that was recorded twice
+                logger.warning('unable to create %s: %s', name, e)
+        try:
+            self.columns('dbmigration_digest')
+        except SQLException:
+            self.execute(
+                'CREATE TABLE dbmigration_digest '
+                '(migrations integer, digest varchar(40));')
+        try:
+            self.columns('dbmigration_progress')
+        except SQLException:
+            self.execute(
+                'CREATE TABLE dbmigration_progress '
+                '(filename varchar(255), sha1 varchar(40), '
+                'last_key varchar(255), rows_affected integer);')
+
+    def up_to_date(self, migrations):
+        """returns True when the performed migrations are exactly the given
+        migrations without fetching them
+
+        the digest of the migrations is saved after every successful
+        migrate and the count of dbmigration guards against rows deleted
+        since then"""
+        try:
+            saved = self.results(
+                'SELECT migrations, digest FROM dbmigration_digest')
+            [(count,)] = self.results('SELECT COUNT(*) FROM dbmigration')
+        except SQLException:
+            return False
+        return (count == len(migrations) and
+                saved == [(count, migrations_digest(migrations))])
+
+    def up_to_date_outside(self, migrations, prefixes):
+        """returns True when the performed migrations whose filenames don't
+        start with any of the timestamp prefixes are exactly the given
+        migrations
 
-    def sql(self, directory, files_sha1s_to_run):
+        only the migrations from the oldest of them on are fetched and the
+        older ones are counted to make sure they all have one of the
+        prefixes"""
+        outside = 'NOT (%s)' % ' OR '.join(
+            'filename LIKE %s' % quote(prefix + '%') for prefix in prefixes)
+        try:
+            if not migrations:
+                [(count,)] = self.results(
+                    'SELECT COUNT(*) FROM dbmigration WHERE ' + outside)
+                return count == 0
+            oldest = quote(min(migrations).filename)
+            [(count,)] = self.results(
+                'SELECT COUNT(*) FROM dbmigration WHERE filename < %s AND %s'
+                % (oldest, outside))
+            newer = self.results(
+                'SELECT filename, sha1 FROM dbmigration WHERE filename >= %s '
+                'ORDER BY filename' % oldest)
+        except SQLException:
+            return False
+        prefixes = tuple(prefixes)
+        return count == 0 and [
+            FilenameSha1(*row) for row in newer
+            if not row[0].startswith(prefixes)] == sorted(migrations)
+
+    def latest_migration(self):
+        """returns the filename of the newest performed migration (None
+        when none have been performed)"""
+        [(latest,)] = self.results('SELECT MAX(filename) FROM dbmigration')
+        return latest
+
+    def save_digest(self, migrations):
+        self.run_batch([Statements([
+            "DELETE FROM dbmigration_digest",
+            "INSERT INTO dbmigration_digest (migrations, digest) "
+            "VALUES (%d, '%s')" % (
+                len(migrations), migrations_digest(migrations))])])
+
+    def columns(self, table):
+        return [d[0] for d in self.cursor_for(
+            'SELECT * FROM %s WHERE 1 = 0' % table).description]
+
+    def sql(self, directory, files_sha1s_to_run, paths=None):
+        """yields the (command, migration) of each migration in filename
+        order, finding them in paths (by filename) when they are in a
+        subdirectory"""
+        paths = paths or {}
         for filename, sha1 in sorted(files_sha1s_to_run):
             command = None
-            sql_statements = []
-            sql_statements.append(
-                '-- start filename: %s sha1: %s' % (filename, sha1))
-            if os.path.splitext(filename)[-1] == '.sql':
-                sql_statements += open(
-                    os.path.join(directory, filename)).read().splitlines()
-            else:
-                command = os.path.join(directory, filename)
-            sql_statements.append(
-                "INSERT INTO dbmigration (filename, sha1, date) "
-                "VALUES ('%s', '%s', %s());" %
-                (filename, sha1, self.date_func))
-            yield command, "\n".join(sql_statements)
+            path = paths.get(filename) or os.path.join(directory, filename)
+            cls = migration_type(path)
+            if cls is None:
+                cls = Migration
+                command = path
+                path = None
+            yield command, cls(self, filename, sha1, path)
+
+    def run(self, migration):
+        """executes a migration a statement at a time in a transaction"""
+        self.run_batch([migration])
+
+    def apply_batch(self, cursor, migrations):
+        for migration in migrations:
+            migration.apply(cursor)
+
+    def build_template(self, key, build, scope=None):
+        """returns a template database for a set of migrations identified by
+        key, calling build with a connection string to migrate if there
+        isn't one already. scope names the migration directory the
+        template belongs to"""
+        raise SQLException(
+            '%s databases can not be templates' % self.__class__.__name__)
+
+    def clone_template(self, template, target):
+        """creates the target database as a copy of a template"""
+        raise SQLException(
+            '%s databases can not be cloned' % self.__class__.__name__)
+
+    # seconds between attempts to take the migration lock
+    lock_poll_interval = 0.5
+
+    def lock(self, timeout=None):
+        """takes the lock that lets a single node migrate the database,
+        waiting at most timeout seconds (forever when it is None) for
+        whichever node has it
+
+        returns whether the lock was taken"""
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.try_lock():
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(self.lock_poll_interval)
+        return True
+
+    def try_lock(self):
+        """takes the migration lock if it's free. engines that can't lock
+        let every node through"""
+        return True
+
+    def unlock(self):
+        pass
+
+    def refresh_lock(self, cursor):
+        """shows the migration lock is still in use from inside of a
+        migration's transaction"""
+        pass
+
+    def close(self):
+        if self.release is not None:
+            self.release(self.connection)
+        else:
+            self.connection.close()
+
+    def dump(self):
+        """yields statements that recreate the schema and data of the
+        database apart from the migration tables"""
+        raise SQLException(
+            '%s databases can not be dumped' % self.__class__.__name__)
+
+    def explain(self, statement):
+        """returns the query plan of a statement as a list of lines or None
+        when the engine can't explain it"""
+        return None
+
+    def executemany(self, cursor, statement, rows):
+        cursor.executemany(statement, rows)
+
+    def rename_migrations(self, renames):
+        """renames (old filename, new filename) pairs in dbmigration in a
+        single transaction
+
+        every row is moved out of the way first so swapping names never
+        trips the unique index on filename"""
+        statement = 'UPDATE dbmigration SET filename = %s WHERE filename = %s'
+        statement = statement.replace('%s', self.placeholder)
+        temporary = [
+            ('renaming-' + hashlib.sha1(old.encode('UTF-8')).hexdigest(), old)
+            for old, new in renames]
+        self.run_batch([
+            ExecuteMany(self, statement, temporary),
+            ExecuteMany(self, statement, [
+                (new, temporary_name) for (old, new), (temporary_name, _)
+                in zip(renames, temporary)])])
+
+    def bulk_load(self, cursor, table, columns, f):
+        """inserts the rows of a CSV file with batched executemany calls
+
+        empty fields are loaded as NULL like postgres' COPY does"""
+        statement = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            table, ', '.join(columns),
+            ', '.join([self.placeholder] * len(columns)))
+        rows = (
+            [field if field != '' else None for field in row]
+            for row in csv.reader(f))
+        rows_affected = 0
+        while True:
+            batch = list(itertools.islice(rows, self.bulk_batch_size))
+            if not batch:
+                return rows_affected
+            self.executemany(cursor, statement, batch)
+            rows_affected += len(batch)
 
     def performed_migrations(self):
-        return [FilenameSha1(r[0], r[1]) for r in self.results(
+        """returns the performed migrations in filename order
+
+        filenames are interned so they share their memory with (and are
+        compared by identity against) the same names in the directory"""
+        return [FilenameSha1(sys.intern(r[0]), r[1]) for r in self.results(
             "SELECT filename, sha1 FROM dbmigration ORDER BY filename")]
 
 
 class sqlite(DatabaseMigrationEngine):
     """a migration engine for sqlite"""
     date_func = 'datetime'
+    dialect = 'sqlite'
+    placeholder = '?'
+    scratch_connection_string = ':memory:'
+    # sqlite only has one writer at a time
+    parallel_workers = 1
+    migration_table_statement = re.compile(
+        r'(CREATE TABLE|INSERT INTO|CREATE (UNIQUE )?INDEX) "?dbmigration')
+    # statements that can't be run inside of the transaction mariposa wraps
+    # around a migration, after the comments in front of them
+    transaction_control = re.compile(
+        r'(\s*--[^\n]*\n)*\s*(BEGIN|COMMIT|END|ROLLBACK|PRAGMA|VACUUM)\b',
+        re.IGNORECASE)
+
+    # the lock row is taken in a BEGIN IMMEDIATE transaction so only one
+    # connection can check for it and insert it at a time
+    lock_table = (
+        'CREATE TABLE IF NOT EXISTS dbmigration_lock '
+        '(host varchar(255), pid integer, owner varchar(32), heartbeat real)')
+    # seconds a lock row is honoured without a heartbeat from its owner,
+    # which refreshes it every heartbeat_interval seconds while it holds it
+    lock_expiry = 30
+    heartbeat_interval = 5
+    heartbeat = None
 
     def __init__(self, connection_string):
-        self.connection = sqlite3.connect(connection_string)
+        # an engine is only used by one thread at a time but it isn't always
+        # the thread that created it
+        import sqlite3
+        self.use_connection(sqlite3.connect(
+            connection_string, check_same_thread=False))
+
+    def use_connection(self, connection):
+        import sqlite3
+        self.engine = sqlite3
+        self.OperationalError = sqlite3.OperationalError
+        self.connection = connection
 
     def execute(self, statement):
         try:
             return self.connection.executescript(statement)
-        except sqlite3.OperationalError as e:
+        except self.OperationalError as e:
             raise SQLException(str(e))
 
     def results(self, statement):
+        return self.cursor_for(statement).fetchall()
+
+    def cursor_for(self, statement):
+        try:
+            return self.connection.execute(statement)
+        except self.OperationalError as e:
+            raise SQLException(str(e))
+
+    def build_template(self, key, build, scope=None):
+        """templates are files in a directory of their own for each
+        migration directory (every project and checkout on a machine share
+        the cache) where only the one for the current migrations is kept"""
+        directory = os.path.join(cache_directory(), 'templates')
+        if scope is not None:
+            directory = os.path.join(directory, scope)
+        template = os.path.join(directory, key + '.db')
+        if os.path.exists(template):
+            return template
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary = '%s.%d' % (template, os.getpid())
+        try:
+            build(temporary)
+            os.rename(temporary, template)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        for filename in os.listdir(directory):
+            if filename.endswith('.db') and filename != key + '.db':
+                os.remove(os.path.join(directory, filename))
+        return template
+
+    def clone_template(self, template, target):
+        # read only so a template that has gone missing is an error instead
+        # of an empty database being created and cloned
+        import urllib.parse
+        try:
+            source = self.engine.connect(
+                'file:%s?mode=ro' % urllib.parse.quote(template), uri=True)
+        except self.OperationalError as e:
+            raise SQLException('unable to open template %s: %s' % (
+                template, e))
+        try:
+            destination = self.engine.connect(target)
+            try:
+                source.backup(destination)
+            finally:
+                destination.close()
+        finally:
+            source.close()
+
+    def dump(self):
+        for statement in self.connection.iterdump():
+            if statement in ('BEGIN TRANSACTION;', 'COMMIT;'):
+                continue
+            if not self.migration_table_statement.match(statement):
+                yield statement
+
+    def explain(self, statement):
+        return [r[-1] for r in self.connection.execute(
+            'EXPLAIN QUERY PLAN ' + statement).fetchall()]
+
+    def try_lock(self):
+        """inserts a row into dbmigration_lock unless another engine's row
+        is there. a row whose heartbeat has expired (its owner crashed,
+        possibly in a container that's gone) or that was left by a process
+        on this host that has exited is taken over"""
+        if not hasattr(self, 'owner'):
+            import uuid
+            self.owner = uuid.uuid4().hex
+        cursor = self.connection.cursor()
+        try:
+            if not self.connection.in_transaction:
+                cursor.execute(self.lock_table)
+                if 'heartbeat' not in self.columns('dbmigration_lock'):
+                    # a lock table made before heartbeats
+                    cursor.execute('ALTER TABLE dbmigration_lock '
+                                   'ADD COLUMN heartbeat real')
+                cursor.execute('BEGIN IMMEDIATE')
+            rows = cursor.execute(
+                'SELECT host, pid, owner, heartbeat '
+                'FROM dbmigration_lock').fetchall()
+            expired = time.time() - self.lock_expiry
+            if rows and not any(
+                    owner == self.owner or abandoned(host, pid) or
+                    (heartbeat or 0) < expired
+                    for host, pid, owner, heartbeat in rows):
+                self.connection.rollback()
+                return False
+            cursor.execute('DELETE FROM dbmigration_lock')
+            cursor.execute(
+                'INSERT INTO dbmigration_lock (host, pid, owner, heartbeat) '
+                'VALUES (?, ?, ?, ?)',
+                (hostname(), os.getpid(), self.owner, time.time()))
+            self.connection.commit()
+        except self.OperationalError:
+            # another connection is writing and kept it busy for too long
+            self.connection.rollback()
+            return False
+        self.start_heartbeat()
+        return True
+
+    def start_heartbeat(self):
+        """refreshes the lock row from a connection of its own until unlock
+
+        while a migration is writing the heartbeat has to wait but so does
+        every other node and the migration's own transaction refreshes
+        the row before it commits"""
+        if self.heartbeat is not None:
+            return
+        path = [row[2] for row in self.connection.execute(
+            'PRAGMA database_list') if row[1] == 'main'][0]
+        if not path:
+            # nothing else can reach an in-memory database
+            return
+        import threading
+        stop = threading.Event()
+
+        def beat():
+            connection = self.engine.connect(path, check_same_thread=False)
+            try:
+                while not stop.wait(self.heartbeat_interval):
+                    try:
+                        connection.execute(
+                            'UPDATE dbmigration_lock SET heartbeat = ? '
+                            'WHERE owner = ?', (time.time(), self.owner))
+                        connection.commit()
+                    except self.OperationalError:
+                        connection.rollback()
+            finally:
+                connection.close()
+        thread = threading.Thread(target=beat)
+        thread.daemon = True
+        thread.start()
+        self.heartbeat = (stop, thread)
+
+    def stop_heartbeat(self):
+        if self.heartbeat is not None:
+            stop, thread = self.heartbeat
+            stop.set()
+            thread.join()
+            self.heartbeat = None
+
+    def refresh_lock(self, cursor):
+        if self.heartbeat is not None:
+            cursor.execute(
+                'UPDATE dbmigration_lock SET heartbeat = ? WHERE owner = ?',
+                (time.time(), self.owner))
+
+    def unlock(self):
+        self.stop_heartbeat()
+        if hasattr(self, 'owner'):
+            self.connection.execute(
+                'DELETE FROM dbmigration_lock WHERE owner = ?', (self.owner,))
+            self.connection.commit()
+
+    def close(self):
+        self.stop_heartbeat()
+        super(sqlite, self).close()
+
+    def index_names(self):
+        return [r[0] for r in self.results(
+            "SELECT name FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = 'dbmigration'")]
+
+    def controls_transactions(self, migration):
+        """whether a migration begins or ends transactions of its own or has
+        statements (PRAGMA foreign_keys) that do nothing inside of one"""
+        if not migration.pipelined or migration.path is None:
+            return False
+        return any(
+            self.transaction_control.match(statement)
+            for statement in migration.statements())
+
+    def run_batch(self, migrations):
+        """executes migrations in a single transaction apart from those
+        that control transactions themselves, which are run on their own"""
+        batch = []
+        for migration in migrations:
+            if self.controls_transactions(migration):
+                if batch:
+                    self.run_transaction(batch)
+                    batch = []
+                self.run_autocommit(migration)
+            else:
+                batch.append(migration)
+        if batch:
+            self.run_transaction(batch)
+
+    def run_autocommit(self, migration):
+        """executes a migration with every statement committed as it runs
+        unless the migration begins a transaction, then records it"""
+        isolation_level = self.connection.isolation_level
+        self.connection.isolation_level = None
+        cursor = self.connection.cursor()
         try:
-            return self.connection.execute(statement).fetchall()
-        except sqlite3.OperationalError as e:
+            migration.apply(cursor)
+            self.refresh_lock(cursor)
+            if self.connection.in_transaction:
+                self.connection.commit()
+        except self.OperationalError as e:
+            if self.connection.in_transaction:
+                self.connection.rollback()
             raise SQLException(str(e))
+        except Exception:
+            if self.connection.in_transaction:
+                self.connection.rollback()
+            raise
+        finally:
+            self.connection.isolation_level = isolation_level
+
+    def run_transaction(self, migrations):
+        cursor = self.connection.cursor()
+        try:
+            if not self.connection.in_transaction:
+                # sqlite3 won't begin a transaction before DDL on its own
+                cursor.execute('BEGIN')
+            self.apply_batch(cursor, migrations)
+            self.refresh_lock(cursor)
+            self.connection.commit()
+        except self.OperationalError as e:
+            self.connection.rollback()
+            raise SQLException(str(e))
+        except Exception:
+            self.connection.rollback()
+            raise
 
 
 class GenericEngine(DatabaseMigrationEngine):
@@ -78,9 +1077,12 @@ class GenericEngine(DatabaseMigrationEngine):
     date_func = 'now'
 
     def __init__(self, connection_string):
-        self.connection = self.engine.connect(
+        self.use_connection(self.engine.connect(
             **loads_string_keys(connection_string)
-        )
+        ))
+
+    def use_connection(self, connection):
+        self.connection = connection
         self.ProgrammingError = self.engine.ProgrammingError
         self.OperationalError = self.engine.OperationalError
 
@@ -96,32 +1098,160 @@ class GenericEngine(DatabaseMigrationEngine):
     def results(self, statement):
         return list(self.execute(statement).fetchall())
 
+    def cursor_for(self, statement):
+        return self.execute(statement)
+
+    def run_batch(self, migrations):
+        """executes migrations in a single transaction"""
+        try:
+            c = self.connection.cursor()
+            self.apply_batch(c, migrations)
+            self.connection.commit()
+        except (self.ProgrammingError, self.OperationalError) as e:
+            self.connection.rollback()
+            raise SQLException(str(e))
+        except Exception:
+            self.connection.rollback()
+            raise
+
 
 class mysql(GenericEngine):
-    """a migration engine for mysql"""
+    """a migration engine for mysql
+
+    MySQLdb rewrites the executemany calls made by bulk_load into multi-row
+    INSERT statements"""
+    dialect = 'mysql'
+    # DDL implicitly commits
+    transactional_ddl = False
 
     def __init__(self, connection_string):
         import MySQLdb
         self.engine = MySQLdb
         super(mysql, self).__init__(connection_string)
 
+    def use_connection(self, connection):
+        import MySQLdb
+        self.engine = MySQLdb
+        super(mysql, self).use_connection(connection)
+
+    def lock(self, timeout=None):
+        # GET_LOCK waits forever when the timeout is negative
+        [(locked,)] = self.results(
+            "SELECT GET_LOCK(CONCAT('mariposa.', DATABASE()), %d)" % (
+                -1 if timeout is None else int(timeout)))
+        return locked == 1
+
+    def unlock(self):
+        self.execute("SELECT RELEASE_LOCK(CONCAT('mariposa.', DATABASE()))")
+
+    def index_names(self):
+        return [r[2] for r in self.results('SHOW INDEX FROM dbmigration')]
+
 
 class postgres(GenericEngine):
     """a migration engine for postgres"""
+    dialect = 'postgres'
+    # characters of SQL sent to the server at once when running a batch
+    pipeline_size = 1024 * 1024
+    # settings templates are built with (the defaults for a connection
+    # that was passed in)
+    connection_dict = {}
+    # the session level advisory lock held while migrating
+    advisory_lock = 0x6d617269706f7361
 
-    migration_table_sql = (
-        "CREATE TABLE dbmigration "
-        "(filename varchar(255), sha1 varchar(40), date timestamp);")
+    migration_table_columns = tuple(
+        (name, 'timestamp' if column_type == 'datetime' else column_type)
+        for name, column_type
+        in DatabaseMigrationEngine.migration_table_columns)
 
     def __init__(self, connection_string):
         import psycopg2
         self.engine = psycopg2
         connection_dict = json.loads(connection_string)
+        self.connection_dict = dict(connection_dict)
         schema = connection_dict.pop('schema', None)
         super(postgres, self).__init__(json.dumps(connection_dict))
         if schema:
             self.execute('SET search_path = %s' % schema)
 
+    def use_connection(self, connection):
+        import psycopg2
+        self.engine = psycopg2
+        super(postgres, self).use_connection(connection)
+
+    def lock(self, timeout=None):
+        """waits for the advisory lock until lock_timeout runs out"""
+        c = self.connection.cursor()
+        try:
+            c.execute("SET lock_timeout = %d" % (
+                0 if timeout is None else max(int(timeout * 1000), 1)))
+            c.execute("SELECT pg_advisory_lock(%d)" % self.advisory_lock)
+            locked = True
+        except self.OperationalError:
+            locked = False
+        # this puts lock_timeout back while the lock belongs to the session
+        # so it outlives the transaction
+        self.connection.rollback()
+        return locked
+
+    def unlock(self):
+        self.execute("SELECT pg_advisory_unlock(%d)" % self.advisory_lock)
+
+    def executemany(self, cursor, statement, rows):
+        """psycopg2's executemany makes a round trip for every row"""
+        from psycopg2.extras import execute_batch
+        execute_batch(cursor, statement, rows, page_size=1000)
+
+    def execute_outside_transaction(self, statement):
+        """executes a statement that postgres won't run in a transaction"""
+        self.connection.autocommit = True
+        try:
+            self.execute(statement)
+        finally:
+            self.connection.autocommit = False
+
+    def build_template(self, key, build, scope=None):
+        """templates are databases named after the key. they are built under
+        a temporary name so a half built template is never cloned"""
+        template = 'mariposa_template_%s' % key
+        if self.results(
+                "SELECT 1 FROM pg_database WHERE datname = '%s'" % template):
+            return template
+        temporary = '%s_%d' % (template, os.getpid())
+        self.execute_outside_transaction('CREATE DATABASE %s' % temporary)
+        try:
+            build(json.dumps(dict(self.connection_dict, database=temporary)))
+            self.execute_outside_transaction(
+                'ALTER DATABASE %s RENAME TO %s' % (temporary, template))
+        except Exception:
+            self.execute_outside_transaction(
+                'DROP DATABASE IF EXISTS %s' % temporary)
+            raise
+        return template
+
+    def clone_template(self, template, target):
+        self.execute_outside_transaction(
+            'CREATE DATABASE %s TEMPLATE %s' % (target, template))
+
+    def explain(self, statement):
+        """explains inside a savepoint so an EXPLAIN that fails doesn't
+        abort the transaction of the migration being explained"""
+        c = self.connection.cursor()
+        c.execute('SAVEPOINT mariposa_explain')
+        try:
+            c.execute('EXPLAIN ' + statement)
+            plan = [r[0] for r in c.fetchall()]
+        except Exception:
+            c.execute('ROLLBACK TO SAVEPOINT mariposa_explain')
+            raise
+        c.execute('RELEASE SAVEPOINT mariposa_explain')
+        return plan
+
+    def index_names(self):
+        return [r[0] for r in self.results(
+            "SELECT indexname FROM pg_indexes WHERE tablename = "
+            "'dbmigration' AND schemaname = current_schema()")]
+
     def execute(self, statement):
         try:
             c = self.connection.cursor()
@@ -131,3 +1261,91 @@ class postgres(GenericEngine):
         except (self.ProgrammingError, self.OperationalError) as e:
             self.connection.rollback()
             raise SQLException(str(e))
+
+    def bulk_load(self, cursor, table, columns, f):
+        cursor.copy_expert(
+            'COPY %s (%s) FROM STDIN WITH CSV' % (table, ', '.join(columns)),
+            f)
+
+    # the statement that notes the time a pipelined migration starts at on
+    # the server, for the duration recorded by pipelined_record
+    pipeline_started = (
+        "SELECT set_config('mariposa.started', "
+        "(clock_timestamp() AT TIME ZONE 'UTC')::text, true)")
+
+    def pipelined_record(self, migration):
+        """returns the statement that records a migration that was sent in
+        the same round trip as others, timed by the server's clock"""
+        started = "current_setting('mariposa.started')::timestamp"
+        return (
+            "INSERT INTO dbmigration (filename, sha1, date, started_at, "
+            "duration_ms, rows_affected, host, deploy) "
+            "VALUES (%s, %s, %s(), %s, (extract(epoch FROM "
+            "(clock_timestamp() AT TIME ZONE 'UTC') - %s) * 1000)::integer, "
+            "NULL, %s, %s)" % (
+                quote(migration.filename), quote(migration.sha1),
+                self.date_func, started, started, quote(hostname()),
+                quote(self.deploy)))
+
+    def apply_batch(self, cursor, migrations):
+        """sends the statements of a batch of migrations to the server in as
+        few round trips as possible
+
+        statements are sent about pipeline_size characters at a time no
+        matter which migration they belong to. the server times each
+        migration with clock_timestamp() since they share round trips,
+        except for scripts which are timed from when they were run. tracers
+        that want every statement timed turn this off. the rest hear about
+        a migration once all of its statements have been sent"""
+        tracer = self.tracer
+        if tracer and tracer.wants_statements:
+            return super(postgres, self).apply_batch(cursor, migrations)
+        pending = []
+        pending_size = 0
+        # the migrations (and when they started) that have all of their
+        # statements pending
+        finished = []
+        for migration in migrations:
+            if not migration.pipelined:
+                self.flush(cursor, pending, finished)
+                pending_size = 0
+                migration.apply(cursor)
+                continue
+            if tracer:
+                tracer.file_started(migration)
+            start = time.time()
+            if migration.started is not None:
+                # the script before the migration already ran so the time
+                # it started at is only known here
+                statements = itertools.chain(migration.statements(), [
+                    migration.record(migration.started).rstrip(';')])
+            else:
+                statements = itertools.chain(
+                    [self.pipeline_started], migration.statements(),
+                    [self.pipelined_record(migration)])
+            for statement in statements:
+                if pending_size >= self.pipeline_size:
+                    self.flush(cursor, pending, finished)
+                    pending_size = 0
+                pending.append(statement)
+                pending_size += len(statement)
+            if tracer:
+                finished.append((migration, start))
+        self.flush(cursor, pending, finished)
+
+    def flush(self, cursor, pending, finished):
+        """sends the pending statements and lets the tracer know that the
+        migrations they finish are done"""
+        try:
+            if pending:
+                # statements can end with a -- comment so the delimiter
+                # gets a line of its own
+                cursor.execute('\n;\n'.join(pending))
+                del pending[:]
+        except Exception as e:
+            for migration, start in finished:
+                self.tracer.file_finished(migration, time.time() - start, e)
+            raise
+        for migration, start in finished:
+            self.tracer.file_finished(migration, time.time() - start)
+        del finished[:]
@@ -0,0 +1,81 @@
+from glob import glob
+import collections
+import time
+
+
+TargetResult = collections.namedtuple(
+    'TargetResult', 'target succeeded duration output')
+
+
+def expand_targets(engine, targets):
+    """returns the connection strings a list of targets refers to
+
+    a target starting with @ names a file with one connection string per
+    line and sqlite targets can be globs of database files"""
+    expanded = []
+    for target in targets:
+        if target.startswith('@'):
+            with open(target[1:]) as f:
+                expanded.extend(
+                    line.strip() for line in f
+                    if line.strip() and not line.startswith('#'))
+        elif engine == 'sqlite' and any(c in target for c in '*?['):
+            expanded.extend(sorted(glob(target)))
+        else:
+            expanded.append(target)
+    return expanded
+
+
+def fan_out(migrate_class, options, targets, command, args, jobs):
+    """runs a command against every target on a pool of jobs threads
+
+    the migration files are hashed once and shared by every target. a
+    failure is recorded in the target's result instead of stopping the
+    other targets"""
+    from concurrent.futures import ThreadPoolExecutor
+    # what is taken to be performed below since differs between targets
+    planner = migrate_class(**dict(options, since=None))
+    try:
+        migrations = planner.current_migrations()
+    finally:
+        planner.close()
+
+    def run(target):
+        start = time.time()
+        mariposa = None
+        try:
+            # a copy of its own since rescanning (with --apply-plan)
+            # replaces the paths in place while other targets use theirs
+            mariposa = migrate_class(**dict(
+                options, connection_string=target, migrations=migrations,
+                paths=dict(planner.paths)))
+            output = command(mariposa, *args)
+            succeeded = True
+        except Exception as e:
+            output = '%s: %s' % (e.__class__.__name__, e)
+            succeeded = False
+        finally:
+            # thousands of targets shouldn't hold their connections and
+            # trace files open until they are garbage collected
+            if mariposa is not None:
+                mariposa.close()
+        return TargetResult(target, succeeded, time.time() - start, output)
+
+    with ThreadPoolExecutor(jobs) as executor:
+        return list(executor.map(run, targets))
+
+
+def summary(results, duration):
+    """returns a report of how each target fared"""
+    lines = []
+    for result in results:
+        lines.append('%-6s %8.2fs  %s' % (
+            'ok' if result.succeeded else 'FAILED', result.duration,
+            result.target))
+        if result.output:
+            lines.extend(
+                '    ' + line for line in str(result.output).splitlines())
+    failed = len([r for r in results if not r.succeeded])
+    lines.append('%d succeeded, %d failed in %.2fs' % (
+        len(results) - failed, failed, duration))
+    return '\n'.join(lines)
@@ -0,0 +1,71 @@
+import hashlib
+import os
+from mariposa.checksums import migrations_digest
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+class PlanException(Exception):
+    pass
+
+
+def digest(plan):
+    """returns the sha1 of everything in a plan apart from its digest"""
+    contents = dict(plan)
+    contents.pop('digest', None)
+    return hashlib.sha1(
+        json.dumps(contents, sort_keys=True).encode('UTF-8')).hexdigest()
+
+
+def make(performed_migrations, migrations):
+    """returns a plan to perform migrations on a database that has
+    performed_migrations
+
+    the plan holds the count and digest of the performed migrations it
+    expects to find, the (filename, sha1) of each migration to perform in
+    order and the count and digest of the migrations that will have been
+    performed once it has been"""
+    performed = list(performed_migrations)
+    migrations = sorted(migrations)
+    plan = {
+        'performed': {
+            'migrations': len(performed),
+            'digest': migrations_digest(performed)},
+        'migrations': [list(migration) for migration in migrations],
+        'result': {
+            'migrations': len(performed) + len(migrations),
+            'digest': migrations_digest(performed + migrations)},
+    }
+    plan['digest'] = digest(plan)
+    return plan
+
+
+def write(path, plan):
+    temporary = '%s.%d' % (path, os.getpid())
+    with open(temporary, 'w') as f:
+        json.dump(plan, f, indent=1, sort_keys=True)
+        f.write('\n')
+    os.rename(temporary, path)
+
+
+def read(path):
+    """returns the plan in a file after checking that it is intact"""
+    with open(path) as f:
+        plan = json.load(f)
+    if plan.get('digest') != digest(plan):
+        raise PlanException('%s has been changed since it was made' % path)
+    return plan
+
+
+def check(plan, performed_migrations):
+    """raises an exception unless the database has performed exactly the
+    migrations the plan was made for"""
+    expected = plan['performed']
+    if (len(performed_migrations) != expected['migrations'] or
+            migrations_digest(performed_migrations) != expected['digest']):
+        raise PlanException(
+            'The %d migrations performed on the database are not the %d the '
+            'plan was made for.' % (
+                len(performed_migrations), expected['migrations']))
@@ -0,0 +1,58 @@
+import collections
+import os
+import sys
+
+
+# a file found under a migration directory, the name it is recorded under
+# (its basename) and the stat information read while scanning
+MigrationFile = collections.namedtuple('MigrationFile', 'filename path stat')
+
+# the files found by a scan in filename order and the timestamp prefixes of
+# the subdirectories that were skipped
+Scan = collections.namedtuple('Scan', 'files skipped')
+
+
+class DuplicateMigrationException(Exception):
+    pass
+
+
+def scan(directory, since=None):
+    """returns every file under directory and its subdirectories in one
+    pass that reads the stat information of each file along the way
+
+    dotfiles and dot directories are left out. migrations are recorded by
+    their basename so their timestamp prefix orders them no matter which
+    subdirectory they are in and two files with the same name are an
+    error. subdirectories named with digits (2012/01) cover the timestamps
+    starting with their names so with since, those that only hold
+    migrations older than it are skipped without being read"""
+    files = {}
+    skipped = []
+    directories = [(directory, '')]
+    while directories:
+        path, prefix = directories.pop()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    key = None
+                    if prefix is not None and entry.name.isdigit():
+                        key = prefix + entry.name
+                    if key and since and key < since[:len(key)]:
+                        skipped.append(key)
+                        continue
+                    directories.append((entry.path, key))
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # deleted while the directory was being read
+                    continue
+                if entry.name in files:
+                    raise DuplicateMigrationException(
+                        '[%s] and [%s] have the same name' % (
+                            files[entry.name].path, entry.path))
+                files[entry.name] = MigrationFile(
+                    sys.intern(entry.name), entry.path, st)
+    return Scan([files[f] for f in sorted(files)], sorted(skipped))
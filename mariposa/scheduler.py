@@ -0,0 +1,68 @@
+class DependencyException(Exception):
+    pass
+
+
+def dependencies(migrations, performed):
+    """returns a dictionary of each pending migration's filename to the set
+    of pending filenames that have to be performed before it
+
+    a migration with a depends header waits for the migrations it names
+    and the last migration before it without a header. a migration without
+    a header waits for every migration before it, which is the order
+    migrations have always been run in"""
+    pending = set(migration.filename for migration in migrations)
+    graph = {}
+    earlier = []
+    barrier = set()
+    for migration in sorted(migrations, key=lambda m: m.filename):
+        depends = migration.depends()
+        if depends is None:
+            graph[migration.filename] = set(earlier)
+            barrier = set([migration.filename])
+        else:
+            for filename in depends:
+                if filename not in pending and filename not in performed:
+                    raise DependencyException(
+                        '[%s] depends on [%s] which does not exist' % (
+                            migration.filename, filename))
+                if filename >= migration.filename:
+                    raise DependencyException(
+                        '[%s] depends on the later migration [%s]' % (
+                            migration.filename, filename))
+            graph[migration.filename] = (
+                set(depends).intersection(pending) | barrier)
+        earlier.append(migration.filename)
+    return graph
+
+
+def run_graph(migrations, graph, run, workers):
+    """calls run with every migration once the migrations it depends on have
+    been run, running up to workers at once
+
+    nothing new is started after a failure and the first exception is
+    raised once the running migrations finish"""
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+    by_filename = dict((m.filename, m) for m in migrations)
+    waiting = dict((f, set(depends)) for f, depends in graph.items())
+    running = {}
+    error = None
+    with ThreadPoolExecutor(workers) as executor:
+        while waiting or running:
+            if error is None:
+                for filename in sorted(waiting):
+                    if not waiting[filename]:
+                        del waiting[filename]
+                        future = executor.submit(run, by_filename[filename])
+                        running[future] = filename
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                filename = running.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                for depends in waiting.values():
+                    depends.discard(filename)
+    if error is not None:
+        raise error
@@ -0,0 +1,125 @@
+import re
+
+
+# $$ or $tag$ opening a postgres dollar quoted string
+DOLLAR_QUOTE = re.compile(r'\$([A-Za-z_][A-Za-z0-9_]*)?\$')
+DELIMITER_COMMAND = re.compile(r'\s*delimiter\s+(\S+)\s*$', re.IGNORECASE)
+
+
+class StatementSplitter(object):
+    """splits SQL fed to it a line at a time into individual statements
+
+    only the statement currently being read is held in memory. quoted
+    strings and identifiers (with backslash escapes in mysql and in postgres
+    E'...' strings), comments, postgres dollar quoting, sqlite
+    trigger bodies and mysql DELIMITER commands are all respected"""
+
+    def __init__(self, dialect=None):
+        self.dialect = dialect
+        self.delimiter = ';'
+        self.pieces = []
+        # the text that will close the string or comment being read
+        self.closing = None
+        # whether a backslash escapes the next character of that string
+        # (mysql strings and postgres E'...' strings)
+        self.backslash = False
+        # whether the statement has anything other than whitespace and
+        # comments in it
+        self.has_code = False
+        if dialect == 'sqlite':
+            # sqlite3 is only imported when it's needed to keep startup fast
+            import sqlite3
+            self.complete_statement = sqlite3.complete_statement
+
+    def _statement(self, end_piece):
+        statement = ''.join(self.pieces) + end_piece
+        self.pieces = []
+        self.has_code = False
+        return statement.strip()
+
+    def feed(self, line):
+        """yields the statements completed by line"""
+        if not line.endswith('\n'):
+            line += '\n'
+        if (self.dialect == 'mysql' and self.closing is None and
+                not self.has_code):
+            match = DELIMITER_COMMAND.match(line)
+            if match:
+                self.delimiter = match.group(1)
+                return
+        mysql = self.dialect == 'mysql'
+        start = i = 0
+        length = len(line)
+        while i < length:
+            if self.closing in ("'", '"', '`'):
+                c = line[i]
+                if c == '\\' and self.backslash:
+                    i += 2
+                    continue
+                if c == self.closing:
+                    # a doubled quote reopens right away on the next pass
+                    self.closing = None
+                i += 1
+                continue
+            if self.closing is not None:
+                end = line.find(self.closing, i)
+                if end == -1:
+                    break
+                i = end + len(self.closing)
+                self.closing = None
+                continue
+            if line.startswith(self.delimiter, i):
+                end = i
+                i += len(self.delimiter)
+                if self.dialect == 'sqlite' and not self.complete_statement(
+                        ''.join(self.pieces) + line[start:end] + ';'):
+                    # a ; inside of a CREATE TRIGGER ... BEGIN ... END
+                    continue
+                if self.has_code:
+                    yield self._statement(line[start:end])
+                else:
+                    self._statement('')
+                start = i
+                continue
+            c = line[i]
+            if line.startswith('--', i) or (c == '#' and mysql):
+                break
+            if line.startswith('/*', i):
+                self.closing = '*/'
+                i += 2
+                continue
+            self.has_code = self.has_code or not c.isspace()
+            if c in ("'", '"', '`'):
+                self.closing = c
+                self.backslash = (mysql and c != '`') or (
+                    c == "'" and self.dialect == 'postgres' and
+                    line[i - 1:i] in ('E', 'e') and
+                    not (line[i - 2:i - 1].isalnum() or
+                         line[i - 2:i - 1] == '_'))
+            elif c == '$' and self.dialect == 'postgres' and (
+                    i == 0 or not (line[i - 1].isalnum() or
+                                   line[i - 1] in '_$')):
+                match = DOLLAR_QUOTE.match(line, i)
+                if match:
+                    self.closing = match.group(0)
+                    i = match.end()
+                    continue
+            i += 1
+        self.pieces.append(line[start:])
+
+    def close(self):
+        """yields the final statement if it wasn't terminated"""
+        if self.has_code:
+            yield self._statement('')
+        self.pieces = []
+
+
+def split_statements(lines, dialect=None):
+    """yields the statements in an iterable of lines of SQL without their
+    delimiters, skipping anything that is only whitespace and comments"""
+    splitter = StatementSplitter(dialect)
+    for line in lines:
+        for statement in splitter.feed(line):
+            yield statement
+    for statement in splitter.close():
+        yield statement
@@ -0,0 +1,86 @@
+from mariposa import api
+from mariposa.dbengines import FilenameSha1
+import asyncio
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import unittest
+
+
+class Pool(object):
+    def __init__(self):
+        self.connection = sqlite3.connect(':memory:', check_same_thread=False)
+        self.borrowed = 0
+
+    def getconn(self):
+        self.borrowed += 1
+        return self.connection
+
+    def putconn(self, connection):
+        self.borrowed -= 1
+
+
+class TestAPI(unittest.TestCase):
+    def setUp(self):
+        self.cache_home = tempfile.mkdtemp()
+        self.old_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.cache_home
+        self.directory = tempfile.mkdtemp()
+        for filename, contents in (
+                ('20120115075349-a.sql', 'CREATE TABLE a (id int);'),
+                ('20120115075350-b.sql', 'INSERT INTO a VALUES (1);')):
+            open(os.path.join(self.directory, filename), 'w').write(contents)
+
+    def tearDown(self):
+        if self.old_cache_home is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.old_cache_home
+        shutil.rmtree(self.cache_home)
+        shutil.rmtree(self.directory)
+
+    def test_migrate_with_connection(self):
+        connection = sqlite3.connect(':memory:')
+        result = api.migrate(self.directory, connection, dry_run=True)
+        self.assertEqual(
+            [(m.filename, m.script) for m in result.planned], [
+                ('20120115075349-a.sql', False),
+                ('20120115075350-b.sql', False)])
+        self.assertEqual(result.performed, [])
+        self.assertFalse(result.up_to_date)
+
+        result = api.migrate(self.directory, connection)
+        self.assertEqual(
+            result.performed,
+            [FilenameSha1(m.filename, m.sha1) for m in result.planned])
+        self.assertTrue(result.duration >= 0)
+        # the connection belongs to the application and is still open
+        self.assertEqual(
+            connection.execute('SELECT id FROM a').fetchall(), [(1,)])
+        self.assertTrue(api.migrate(self.directory, connection).up_to_date)
+
+    def test_migrate_with_pool(self):
+        pool = Pool()
+        result = api.migrate(self.directory, pool=pool)
+        self.assertEqual(len(result.performed), 2)
+        self.assertEqual(pool.borrowed, 0)
+
+    def test_warnings_are_collected(self):
+        connection = sqlite3.connect(':memory:')
+        api.migrate(self.directory, connection)
+        open(os.path.join(self.directory, '20120115075348-c.sql'), 'w').write(
+            'CREATE TABLE c (id int);')
+        with self.assertLogs('mariposa.api', 'WARNING'):
+            result = api.migrate(self.directory, connection, out_of_order=True)
+        self.assertEqual(
+            result.warnings, ['Running [20120115075348-c.sql] out of order.'])
+
+    def test_migrate_async(self):
+        connection = sqlite3.connect(':memory:', check_same_thread=False)
+
+        async def boot():
+            return await api.migrate_async(self.directory, connection)
+        result = asyncio.run(boot())
+        self.assertEqual(len(result.performed), 2)
@@ -1,11 +1,31 @@
 from mariposa.core import (
-    DBMigrate, OutOfOrderException, ModifiedMigrationException
+    DBMigrate, OutOfOrderException, ModifiedMigrationException,
+    pending_migrations, reconcile_renames
 )
-from mariposa.dbengines import loads_string_keys
+from mariposa.bundle import BundleException
+from mariposa.checksums import (
+    cache_path, directory_key, git_index_sha1s, migrations_digest
+)
+from mariposa import api, dbengines, plans, scanning, scheduler, tracing
+from mariposa.dbengines import SQLException, loads_string_keys
+from mariposa.fanout import expand_targets, fan_out, summary
+from mariposa.command import command
+import collections
+import datetime
+import io
+import json
 import subprocess
+import sys
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import os
+import re
 
 import unittest
+from unittest import mock
 
 
 class FakeFile(object):
@@ -28,6 +48,9 @@ class TestDBMigrate(unittest.TestCase):
             'engine': engine,
             'connection_string': connection_string,
         }
+        self.cache_home = tempfile.mkdtemp()
+        self.old_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.cache_home
         if engine == 'mysql':
             import MySQLdb
             connection_settings = loads_string_keys(connection_string)
@@ -56,6 +79,26 @@ class TestDBMigrate(unittest.TestCase):
                 c.cursor().execute('CREATE SCHEMA %s' % schema)
                 c.commit()
 
+    def tearDown(self):
+        if self.old_cache_home is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.old_cache_home
+        shutil.rmtree(self.cache_home)
+
+    def migration_directory(self, **files):
+        """creates a temporary migration directory with files old enough
+        to be cached"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for filename, contents in files.items():
+            path = os.path.join(directory, filename)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').write(contents)
+            os.utime(path, (1, 1))
+        return directory
+
     def test_create(self):
         self.settings['directory'] = '/tmp'
         mariposa = DBMigrate(**self.settings)
@@ -276,3 +319,1339 @@ class TestDBMigrate(unittest.TestCase):
               '4aebd2514665effff5105ad568a4fbe62f567087'),
              ('20120115075349-create-user-table.sql',
               '0187aa5e13e268fc621c894a7ac4345579cf50b7')])
+
+    def test_cached_migrations_are_not_rehashed(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);'})
+        mariposa = DBMigrate(**self.settings)
+        current_migrations = mariposa.current_migrations()
+        self.assertTrue(os.path.exists(cache_path(mariposa.directory)))
+
+        def blobsha1(filename):
+            self.fail('%s should have been cached' % filename)
+        mariposa.blobsha1 = blobsha1
+        self.assertEqual(mariposa.current_migrations(), current_migrations)
+
+    def test_cache_invalidated_by_modification(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);'})
+        mariposa = DBMigrate(**self.settings)
+        old_sha1 = mariposa.current_migrations()[0].sha1
+        path = os.path.join(mariposa.directory, '20120115075349-a.sql')
+        open(path, 'w').write('CREATE TABLE a (id int, b int);')
+        os.utime(path, (2, 2))
+        new_sha1 = mariposa.current_migrations()[0].sha1
+        self.assertNotEqual(old_sha1, new_sha1)
+        self.assertEqual(new_sha1, mariposa.blobsha1(path))
+
+    def test_no_cache(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);'})
+        self.settings['cache'] = False
+        mariposa = DBMigrate(**self.settings)
+        mariposa.current_migrations()
+        self.assertFalse(os.path.exists(cache_path(mariposa.directory)))
+
+    def test_verify_cache_warns_about_stale_entries(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);'})
+        mariposa = DBMigrate(**self.settings)
+        mariposa.current_migrations()
+        mariposa.verify_cache = True
+        warnings = []
+        mariposa.warn = warnings.append
+        mariposa.blobsha1 = lambda filename: '0' * 40
+        self.assertEqual(mariposa.current_migrations()[0].sha1, '0' * 40)
+        self.assertEqual(
+            warnings, ['Cached sha1 for [20120115075349-a.sql] was stale.'])
+
+    def test_git_index_sha1s(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);',
+            '20120115075350-b.sql': 'CREATE TABLE b (id int);',
+            '20120115075351-c.sql': 'CREATE TABLE c (id int);'})
+        self.settings['git_index'] = True
+        self.settings['cache'] = False
+        mariposa = DBMigrate(**self.settings)
+        expected = sorted(mariposa.current_migrations())
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                ['git', 'init', '-q', '.'], cwd=mariposa.directory)
+            subprocess.check_call(
+                ['git', 'add', '20120115075349-a.sql', '20120115075350-b.sql'],
+                cwd=mariposa.directory, stdout=devnull)
+        open(os.path.join(mariposa.directory, '20120115075350-b.sql'),
+             'a').write('\n')
+        self.assertEqual(
+            git_index_sha1s(mariposa.directory),
+            {'20120115075349-a.sql': expected[0].sha1})
+
+        blobsha1 = mariposa.blobsha1
+        hashed = []
+
+        def tracking_blobsha1(filename):
+            hashed.append(os.path.basename(filename))
+            return blobsha1(filename)
+        mariposa.blobsha1 = tracking_blobsha1
+        current_migrations = sorted(mariposa.current_migrations())
+        self.assertEqual(current_migrations[0], expected[0])
+        self.assertEqual(current_migrations[2], expected[2])
+        self.assertEqual(
+            sorted(hashed), ['20120115075350-b.sql', '20120115075351-c.sql'])
+
+    def test_git_index_sha1s_with_conversions(self):
+        directory = self.migration_directory(**{
+            '.gitattributes': '*.sql text eol=crlf\n*.csv filter=copy\n',
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);\r\n',
+            '20120115075350-b.csv': '-- table: a\nid\n1\n',
+            '20120115075351-c.sh': '#!/bin/sh\n'})
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['git', 'init', '-q', '.'], cwd=directory)
+            subprocess.check_call(
+                ['git', 'config', 'filter.copy.clean', 'cat'], cwd=directory)
+            subprocess.check_call(
+                ['git', 'add', '.'], cwd=directory, stdout=devnull)
+        self.settings['directory'] = directory
+        self.settings['cache'] = False
+        expected = DBMigrate(**self.settings).current_migrations()
+        # the index has the sql file with lf line endings and the csv as
+        # its filter left it
+        self.assertEqual(sorted(git_index_sha1s(directory)),
+                         ['.gitattributes', '20120115075351-c.sh'])
+        self.settings['git_index'] = True
+        self.assertEqual(
+            DBMigrate(**self.settings).current_migrations(), expected)
+
+    def test_git_index_sha1s_outside_of_git(self):
+        directory = self.migration_directory()
+        os.environ['GIT_CEILING_DIRECTORIES'] = os.path.dirname(directory)
+        try:
+            self.assertEqual(git_index_sha1s(directory), {})
+        finally:
+            del os.environ['GIT_CEILING_DIRECTORIES']
+
+    def test_blobsha1_matches_git(self):
+        directory = self.migration_directory(**{
+            'empty.sql': '',
+            'small.sql': 'CREATE TABLE a (id int);\n'})
+        large = os.path.join(directory, 'large.sql')
+        with open(large, 'wb') as f:
+            for i in range(50000):
+                f.write(b'INSERT INTO a VALUES (%d);\r\n' % i)
+        self.settings['directory'] = directory
+        mariposa = DBMigrate(**self.settings)
+        for filename in ('empty.sql', 'small.sql', 'large.sql'):
+            path = os.path.join(directory, filename)
+            self.assertEqual(
+                mariposa.blobsha1(path),
+                subprocess.check_output(
+                    ['git', 'hash-object', '--no-filters', path]
+                ).decode('UTF-8').strip())
+
+    def test_failed_migration_is_rolled_back(self):
+        if self.settings['engine'] == 'mysql':
+            self.skipTest('mysql implicitly commits DDL')
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': (
+                "CREATE TABLE a (id int);\n"
+                "INSERT INTO a VALUES (1);\n"
+                "CREATE TABLE a (id int);\n")})
+        mariposa = DBMigrate(**self.settings)
+        self.assertRaises(SQLException, mariposa.migrate)
+        self.assertEqual(mariposa.engine.performed_migrations(), [])
+        self.assertRaises(
+            SQLException, mariposa.engine.results, 'SELECT * FROM a')
+
+    def test_statements_executed_individually(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': (
+                "CREATE TABLE a (id int, name varchar(20));\n"
+                "-- a comment; with a semicolon\n"
+                "INSERT INTO a VALUES (1, 'one;');\n"
+                "INSERT INTO a VALUES (2, 'two')")})
+        mariposa = DBMigrate(**self.settings)
+        mariposa.migrate()
+        self.assertEqual(
+            sorted(mariposa.engine.results('SELECT id, name FROM a')),
+            [(1, 'one;'), (2, 'two')])
+        self.assertEqual(
+            [m.filename for m in mariposa.engine.performed_migrations()],
+            ['20120115075349-a.sql'])
+
+    def test_bulk_load_migration(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': (
+                'CREATE TABLE a (id int, name varchar(20));'),
+            '20120115075350-a.csv': (
+                '-- table: a\n'
+                '-- columns: id, name\n'
+                '1,one\n'
+                '2,"two, too"\n'
+                '3,\n'),
+            '20120115075351-a.csv': (
+                '-- table: a\n'
+                'name,id\n'
+                'four,4\n')})
+        mariposa = DBMigrate(**self.settings)
+        mariposa.engine.bulk_batch_size = 2
+        mariposa.migrate()
+        self.assertEqual(
+            sorted(mariposa.engine.results('SELECT id, name FROM a')),
+            [(1, 'one'), (2, 'two, too'), (3, None), (4, 'four')])
+        self.assertEqual(
+            sorted(mariposa.engine.performed_migrations()),
+            sorted(mariposa.current_migrations()))
+
+    def batches(self, mariposa):
+        batches = []
+        run_batch = mariposa.engine.run_batch
+
+        def tracking_run_batch(migrations):
+            if isinstance(migrations[0], dbengines.Migration):
+                batches.append([m.filename for m in migrations])
+            return run_batch(migrations)
+        mariposa.engine.run_batch = tracking_run_batch
+        return batches
+
+    def test_batch_migration(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);',
+            '20120115075350-b.sql': 'CREATE TABLE b (id int);',
+            '20120115075351-c.sql': 'CREATE TABLE c (id int);'})
+        self.settings['batch'] = True
+        mariposa = DBMigrate(**self.settings)
+        batches = self.batches(mariposa)
+        mariposa.migrate()
+        if mariposa.engine.transactional_ddl:
+            self.assertEqual(batches, [[
+                '20120115075349-a.sql', '20120115075350-b.sql',
+                '20120115075351-c.sql']])
+        self.assertEqual(
+            sorted(mariposa.engine.performed_migrations()),
+            sorted(mariposa.current_migrations()))
+
+    def test_batch_size_and_script_boundaries(self):
+        self.settings['directory'] = os.path.join(
+            os.path.dirname(__file__), 'fixtures', 'arbitrary-scripts')
+        self.settings['batch'] = True
+        self.settings['batch_size'] = 1
+        mariposa = DBMigrate(**self.settings)
+        batches = self.batches(mariposa)
+        mariposa.migrate()
+        if mariposa.engine.transactional_ddl:
+            self.assertEqual(batches, [
+                ['20121019152404-initial.sql'],
+                ['20121019152409-script.sh'],
+                ['20121019152412-final.sql']])
+        self.assertEqual(len(mariposa.engine.performed_migrations()), 3)
+
+    def test_failed_batch_is_rolled_back(self):
+        if self.settings['engine'] == 'mysql':
+            self.skipTest('mysql implicitly commits DDL')
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);',
+            '20120115075350-b.sql': 'CREATE TABLE a (id int);'})
+        self.settings['batch'] = True
+        mariposa = DBMigrate(**self.settings)
+        self.assertRaises(SQLException, mariposa.migrate)
+        self.assertEqual(mariposa.engine.performed_migrations(), [])
+
+    def test_sqlite_migrations_that_control_transactions(self):
+        if self.settings['engine'] != 'sqlite':
+            self.skipTest('sqlite wraps migrations in BEGIN')
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': (
+                'CREATE TABLE a (id int PRIMARY KEY);\n'
+                'CREATE TABLE b (a_id int REFERENCES a (id));'),
+            '20120115075350-b.sql': (
+                '-- foreign keys are only switched on outside of a '
+                'transaction\n'
+                'PRAGMA foreign_keys = ON;'),
+            '20120115075351-c.sql': (
+                'BEGIN;\n'
+                'INSERT INTO a VALUES (1);\n'
+                'COMMIT;'),
+            '20120115075352-d.sql': 'INSERT INTO b VALUES (1);'})
+        self.settings['batch'] = True
+        mariposa = DBMigrate(**self.settings)
+        mariposa.migrate()
+        self.assertEqual(
+            mariposa.engine.performed_migrations(),
+            mariposa.current_migrations())
+        self.assertEqual(
+            mariposa.engine.results('PRAGMA foreign_keys'), [(1,)])
+        self.assertRaises(
+            sqlite3.IntegrityError, mariposa.engine.execute,
+            'INSERT INTO b VALUES (2);')
+
+    def test_fan_out(self):
+        if self.settings['engine'] != 'sqlite':
+            self.skipTest('fans out across sqlite files')
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);'})
+        databases = self.migration_directory()
+        for name in ('one', 'two', 'three'):
+            open(os.path.join(databases, name + '.db'), 'w').close()
+        # two.db isn't a database so it fails without stopping the others
+        open(os.path.join(databases, 'two.db'), 'w').write('garbage' * 1000)
+        targets = expand_targets(
+            'sqlite', [os.path.join(databases, '*.db')])
+        self.assertEqual(
+            [os.path.basename(target) for target in targets],
+            ['one.db', 'three.db', 'two.db'])
+
+        hashed = []
+        instances = []
+
+        class CountingDBMigrate(DBMigrate):
+            def __init__(self, **options):
+                DBMigrate.__init__(self, **options)
+                instances.append(self)
+
+            def blobsha1(self, filename):
+                hashed.append(filename)
+                return DBMigrate.blobsha1(self, filename)
+
+            def connect(self):
+                self.connected = DBMigrate.connect(self)
+                return self.connected
+        self.settings['cache'] = False
+        self.settings['trace'] = os.path.join(databases, 'trace.json')
+        results = fan_out(
+            CountingDBMigrate, self.settings, targets,
+            command.commands['migrate'], [], 2)
+        self.assertEqual(len(hashed), 1)
+        # every target's connection and trace is closed once it's done
+        self.assertEqual(len(instances), 4)
+        for instance in instances:
+            self.assertTrue(instance.tracer.tracers[0].file.closed)
+        # rescanning one target mustn't change the paths another is using
+        self.assertEqual(
+            len(set(id(instance.paths) for instance in instances)), 4)
+        for instance in instances[1:]:
+            self.assertRaises(
+                sqlite3.ProgrammingError,
+                instance.connected.connection.execute, 'SELECT 1')
+        del self.settings['trace']
+        self.assertEqual(
+            [result.succeeded for result in results], [True, True, False])
+        for target in targets[:2]:
+            self.settings['connection_string'] = target
+            self.assertEqual(
+                DBMigrate(**self.settings).engine.performed_migrations()[0]
+                .filename, '20120115075349-a.sql')
+        report = summary(results, 1.0)
+        self.assertTrue(report.endswith('2 succeeded, 1 failed in 1.00s'))
+        self.assertTrue('FAILED' in report)
+
+    def test_migration_timings_recorded(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': (
+                'CREATE TABLE a (id int);\n'
+                'INSERT INTO a VALUES (1);\n'
+                'INSERT INTO a VALUES (2);\n')})
+        mariposa = DBMigrate(**self.settings)
+        mariposa.migrate()
+        [(duration_ms, rows_affected, host, deploy)] = (
+            mariposa.engine.results(
+                'SELECT duration_ms, rows_affected, host, deploy '
+                'FROM dbmigration'))
+        self.assertTrue(duration_ms >= 0)
+        self.assertEqual(rows_affected, 2)
+        self.assertEqual(host, dbengines.hostname())
+        self.assertTrue(deploy.endswith('@' + dbengines.hostname()))
+        stats = mariposa.stats()
+        self.assertTrue('20120115075349-a.sql (2 rows on' in stats)
+        self.assertTrue('%s (1 migrations' % deploy in stats)
+
+    def test_migration_table_upgraded(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);',
+            '20120115075350-b.sql': 'CREATE TABLE b (id int);'})
+        mariposa = DBMigrate(**self.settings)
+        mariposa.engine.execute(
+            'CREATE TABLE dbmigration '
+            '(filename varchar(255), sha1 varchar(40), date datetime);')
+        mariposa.engine.execute(
+            "INSERT INTO dbmigration (filename, sha1) VALUES ("
+            "'20120115075349-a.sql', '%s');" %
+            sorted(mariposa.current_migrations())[0].sha1)
+        self.assertEqual(
+            mariposa.stats(), 'No migration timings have been recorded.')
+        mariposa.migrate()
+        self.assertEqual(
+            [c for c, t in mariposa.engine.migration_table_columns],
+            mariposa.engine.columns('dbmigration'))
+        self.assertTrue(set(['dbmigration_filename', 'dbmigration_sha1'])
+                        .issubset(mariposa.engine.index_names()))
+        self.assertEqual(
+            mariposa.engine.results(
+                'SELECT filename, duration_ms IS NULL FROM dbmigration '
+                'ORDER BY filename'),
+            [('20120115075349-a.sql', True),
+             ('20120115075350-b.sql', False)])
+
+    def test_migration_table_indexes(self):
+        self.settings['directory'] = os.path.join(
+            os.path.dirname(__file__), 'fixtures', 'initial')
+        mariposa = DBMigrate(**self.settings)
+        mariposa.migrate()
+        self.assertTrue(set(['dbmigration_filename', 'dbmigration_sha1'])
+                        .issubset(mariposa.engine.index_names()))
+
+    def test_up_to_date_database_skips_performed_migrations(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);',
+            '20120115075350-b.sql': 'CREATE TABLE b (id int);'})
+        mariposa = DBMigrate(**self.settings)
+        mariposa.migrate()
+        performed_migrations = mariposa.engine.performed_migrations
+
+        def fail():
+            self.fail('performed migrations should not have been fetched')
+        mariposa.engine.performed_migrations = fail
+        mariposa.migrate()
+        mariposa.dry_run = True
+        self.assertEqual(mariposa.migrate(), None)
+
+        # a deleted row means the saved digest can't be trusted
+        mariposa.engine.performed_migrations = performed_migrations
+        mariposa.dry_run = False
+        mariposa.engine.run_batch([dbengines.Statements([
+            "DROP TABLE b",
+            "DELETE FROM dbmigration WHERE filename = '20120115075350-b.sql'"
+        ])])
+        self.assertFalse(
+            mariposa.engine.up_to_date(mariposa.current_migrations()))
+        mariposa.migrate()
+        self.assertTrue(
+            mariposa.engine.up_to_date(mariposa.current_migrations()))
+
+    def test_trace(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': (
+                'CREATE TABLE a (id int);\n'
+                'INSERT INTO a VALUES (1);\n')})
+        trace = os.path.join(self.migration_directory(), 'trace.json')
+        self.settings['trace'] = trace
+        mariposa = DBMigrate(**self.settings)
+        events = []
+
+        class RecordingTracer(tracing.Tracer):
+            def file_finished(self, migration, duration, error=None):
+                events.append((migration.filename, error))
+        mariposa.tracer.append(RecordingTracer())
+        mariposa.migrate()
+        self.assertEqual(events, [('20120115075349-a.sql', None)])
+        traced = [json.loads(line) for line in open(trace)]
+        self.assertEqual(
+            [(event['event'], event.get('statement')) for event in traced], [
+                ('plan_computed', None),
+                ('file_started', None),
+                ('statement_started',
+                 '-- start filename: 20120115075349-a.sql sha1: %s\n'
+                 'CREATE TABLE a (id int)' % traced[1]['sha1']),
+                ('statement_finished',
+                 '-- start filename: 20120115075349-a.sql sha1: %s\n'
+                 'CREATE TABLE a (id int)' % traced[1]['sha1']),
+                ('statement_started', 'INSERT INTO a VALUES (1)'),
+                ('statement_finished', 'INSERT INTO a VALUES (1)'),
+                ('file_finished', None)])
+        self.assertEqual(traced[0]['migrations'], ['20120115075349-a.sql'])
+        self.assertTrue(traced[-1]['duration_ms'] >= 0)
+
+    def test_slow_statements_logged(self):
+        if self.settings['engine'] != 'sqlite':
+            self.skipTest('checks the sqlite query plan')
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': (
+                'CREATE TABLE a (id int);\n'
+                'UPDATE a SET id = 2 WHERE id = 1;\n')})
+        self.settings['slow_threshold'] = 0
+        self.settings['explain'] = True
+        mariposa = DBMigrate(**self.settings)
+        with self.assertLogs('mariposa.tracing', 'WARNING') as logs:
+            mariposa.migrate()
+        self.assertEqual(len(logs.output), 2)
+        self.assertTrue(
+            'slow statement in 20120115075349-a.sql' in logs.output[1])
+        self.assertTrue('SCAN a' in logs.output[1])
+
+    def test_slow_statements_that_cant_be_explained(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': (
+                'CREATE TABLE a (id int, n int);\n'
+                'INSERT INTO a VALUES (1, 0);\n'),
+            '20120115075350-b.backfill': (
+                '-- table: a\n'
+                '-- key: id\n'
+                'UPDATE a SET n = n + 1 WHERE id >= :start AND id <= :end;\n'
+            ),
+            '20120115075351-c.sql': 'UPDATE a SET n = n + 1;\n'})
+        self.settings['slow_threshold'] = 0
+        self.settings['explain'] = True
+        mariposa = DBMigrate(**self.settings)
+        explained = []
+
+        def explain(statement):
+            explained.append(statement)
+            raise SQLException('no plan for you')
+        mariposa.engine.explain = explain
+        with self.assertLogs('mariposa.tracing', 'WARNING') as logs:
+            mariposa.migrate()
+        # the backfill's statement has parameters so it isn't explained
+        self.assertEqual(len(explained), 2)
+        self.assertTrue(explained[1].endswith('\nUPDATE a SET n = n + 1'))
+        self.assertTrue(any(
+            'unable to explain a statement in 20120115075351-c.sql: no plan '
+            'for you' in line for line in logs.output))
+        self.assertEqual(
+            mariposa.engine.results('SELECT n FROM a'), [(2,)])
+
+    def test_squash(self):
+        if self.settings['engine'] != 'sqlite':
+            self.skipTest('squash builds its scratch database with sqlite')
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': (
+                'CREATE TABLE a (id int, name varchar(20));\n'
+                "INSERT INTO a VALUES (1, 'it''s');\n"),
+            '20120115075350-b.sql': 'ALTER TABLE a ADD COLUMN b int;',
+            '20120115075351-c.sql': 'INSERT INTO a VALUES (2, NULL, 3);'})
+        mariposa = DBMigrate(**self.settings)
+        mariposa.dry_run = True
+        self.assertEqual(
+            mariposa.squash('20120115075350-b.sql'),
+            'Would create %s replacing 2 migrations' % os.path.join(
+                mariposa.directory, '20120115075350-b.baseline'))
+        mariposa.dry_run = False
+        mariposa.squash('20120115075350-b.sql')
+        self.assertEqual(
+            [m.filename for m in mariposa.current_migrations()].count(
+                '20120115075350-b.baseline'), 0)
+
+        events = []
+
+        class RecordingTracer(tracing.Tracer):
+            def file_finished(self, migration, duration, error=None):
+                events.append(migration.filename)
+        mariposa.tracer.append(RecordingTracer())
+        mariposa.migrate()
+        self.assertEqual(
+            events, ['20120115075350-b.baseline', '20120115075351-c.sql'])
+        self.assertEqual(
+            sorted(mariposa.engine.performed_migrations()),
+            sorted(mariposa.current_migrations()))
+        self.assertEqual(
+            mariposa.engine.results('SELECT id, name, b FROM a ORDER BY id'),
+            [(1, "it's", None), (2, None, 3)])
+
+    def test_baseline_ignored_by_existing_databases(self):
+        if self.settings['engine'] != 'sqlite':
+            self.skipTest('squash builds its scratch database with sqlite')
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);'})
+        mariposa = DBMigrate(**self.settings)
+        mariposa.migrate()
+        path = os.path.join(mariposa.directory, '20120115075349-a.sql')
+        open(path, 'w').write('CREATE TABLE a (id int, b int);')
+        mariposa.squash()
+        self.assertRaises(ModifiedMigrationException, mariposa.migrate)
+
+    def test_baseline_from_another_engine(self):
+        if self.settings['engine'] != 'sqlite':
+            self.skipTest('squash builds its scratch database with sqlite')
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);',
+            '20120115075350-b.sql': 'INSERT INTO a VALUES (1);'})
+        DBMigrate(**self.settings).squash()
+        baseline = os.path.join(
+            self.settings['directory'], '20120115075350-b.baseline')
+        self.assertTrue('-- engine: sqlite\n' in open(baseline).read())
+
+        mariposa = DBMigrate(**self.settings)
+        mariposa.engine
+        # a sqlite dump would be replayed into the other database
+        mariposa.engine_name = 'postgres'
+        warnings = []
+        mariposa.warn = warnings.append
+        events = []
+
+        class RecordingTracer(tracing.Tracer):
+            def file_finished(self, migration, duration, error=None):
+                events.append(migration.filename)
+        mariposa.tracer.append(RecordingTracer())
+        mariposa.migrate()
+        self.assertEqual(warnings, [
+            'Ignoring [20120115075350-b.baseline] since it was written by '
+            'sqlite.'])
+        self.assertEqual(
+            events, ['20120115075349-a.sql', '20120115075350-b.sql'])
+
+    def test_provision(self):
+        if self.settings['engine'] != 'sqlite':
+            self.skipTest('provisions sqlite files')
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': (
+                'CREATE TABLE a (id int);\n'
+                'INSERT INTO a VALUES (1);\n')})
+        mariposa = DBMigrate(**self.settings)
+        databases = self.migration_directory()
+        one = os.path.join(databases, 'one.db')
+        two = os.path.join(databases, 'two.db')
+        mariposa.provision(one)
+
+        def build(connection_string):
+            self.fail('the template should have been reused')
+        build_template = mariposa.engine.build_template
+        mariposa.engine.build_template = (
+            lambda key, _, scope: build_template(key, build, scope))
+        mariposa.provision(two)
+        for target in (one, two):
+            self.settings['connection_string'] = target
+            provisioned = DBMigrate(**self.settings)
+            self.assertEqual(
+                provisioned.engine.results('SELECT id FROM a'), [(1,)])
+            self.assertEqual(
+                provisioned.engine.performed_migrations(),
+                mariposa.current_migrations())
+        templates = os.path.join(
+            self.cache_home, 'mariposa', 'templates',
+            directory_key(mariposa.directory))
+        old_templates = os.listdir(templates)
+        self.assertEqual(len(old_templates), 1)
+
+        # a new migration means a new template
+        path = os.path.join(mariposa.directory, '20120115075350-b.sql')
+        open(path, 'w').write('CREATE TABLE b (id int);')
+        mariposa.engine.build_template = build_template
+        mariposa.provision(os.path.join(databases, 'three.db'))
+        self.assertEqual(os.listdir(templates), [
+            migrations_digest(mariposa.current_migrations())[:16] + '.db'])
+        self.assertNotEqual(os.listdir(templates), old_templates)
+
+    def test_provision_from_two_directories(self):
+        if self.settings['engine'] != 'sqlite':
+            self.skipTest('provisions sqlite files')
+        databases = self.migration_directory()
+        projects = []
+        for table in ('a', 'b'):
+            self.settings['directory'] = self.migration_directory(**{
+                '20120115075349-%s.sql' % table:
+                    'CREATE TABLE %s (id int);' % table})
+            projects.append(DBMigrate(**self.settings))
+        built = []
+        for project in projects * 2:
+            build_template = project.engine.build_template
+
+            def counting_build_template(key, build, scope,
+                                        build_template=build_template):
+                return build_template(
+                    key, lambda c: (built.append(c), build(c)), scope)
+            project.engine.build_template = counting_build_template
+            target = os.path.join(databases, '%d.db' % len(os.listdir(
+                databases)))
+            project.provision(target)
+            self.settings['connection_string'] = target
+            self.assertEqual(
+                DBMigrate(**self.settings).engine.performed_migrations(),
+                project.current_migrations())
+        # neither project threw the other's template away
+        self.assertEqual(len(built), 2)
+
+    def test_clone_missing_template(self):
+        if self.settings['engine'] != 'sqlite':
+            self.skipTest('clones sqlite files')
+        self.settings['directory'] = self.migration_directory()
+        mariposa = DBMigrate(**self.settings)
+        databases = self.migration_directory()
+        self.assertRaises(
+            SQLException, mariposa.engine.clone_template,
+            os.path.join(databases, 'gone.db'),
+            os.path.join(databases, 'target.db'))
+        self.assertEqual(os.listdir(databases), [])
+
+    def test_renamed_swaps_and_quotes(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);',
+            "20120115075350-it's-b.sql": 'CREATE TABLE b (id int);'})
+        mariposa = DBMigrate(**self.settings)
+        mariposa.migrate()
+        old = dict((v, k) for k, v in mariposa.current_migrations())
+        mariposa.directory = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE b (id int);',
+            "20120115075350-it's-b.sql": 'CREATE TABLE a (id int);'})
+        mariposa.dry_run = True
+        self.assertEqual(sorted(mariposa.renamed().splitlines()), [
+            "UPDATE dbmigration SET filename = '20120115075349-a.sql' "
+            "WHERE filename = '20120115075350-it''s-b.sql';",
+            "UPDATE dbmigration SET filename = '20120115075350-it''s-b.sql' "
+            "WHERE filename = '20120115075349-a.sql';"])
+        mariposa.dry_run = False
+        mariposa.renamed()
+        self.assertEqual(
+            sorted(mariposa.engine.performed_migrations()),
+            sorted(mariposa.current_migrations()))
+        self.assertNotEqual(
+            old, dict((v, k) for k, v in mariposa.current_migrations()))
+
+    def test_renamed_conflicts(self):
+        performed = [('1-a.sql', 'x'), ('2-b.sql', 'x'), ('3-c.sql', 'y'),
+                     ('4-d.sql', 'z')]
+        current = [('1-a2.sql', 'x'), ('2-b2.sql', 'x'), ('3-c.sql', 'y'),
+                   ('4-d.sql', 'z'), ('5-e.sql', 'y')]
+        self.assertEqual(
+            reconcile_renames(performed, current),
+            ([], [('x', ['1-a.sql', '2-b.sql'], ['1-a2.sql', '2-b2.sql'])]))
+        self.assertEqual(
+            reconcile_renames(performed, current[2:] + [('2-b.sql', 'x')]),
+            ([], []))
+        self.assertEqual(
+            reconcile_renames(performed[1:], current[1:]),
+            ([('2-b.sql', '2-b2.sql')], []))
+
+    def test_postgres_batches_share_round_trips(self):
+        directory = self.migration_directory(**dict(
+            ('2012011507%04d-m.sql' % i, 'INSERT INTO a VALUES (%d);' % i)
+            for i in range(10)))
+        engine = dbengines.postgres.__new__(dbengines.postgres)
+        engine.tracer = tracing.Tracers()
+        engine.deploy = 'deploy'
+        engine.pipeline_size = 2000
+        migrations = [
+            dbengines.Migration(engine, filename, '0' * 40,
+                                os.path.join(directory, filename))
+            for filename in sorted(os.listdir(directory))]
+        executed = []
+        cursor = mock.Mock()
+        cursor.execute = executed.append
+        engine.apply_batch(cursor, migrations)
+        # ten migrations of three statements each in a few round trips
+        self.assertTrue(1 < len(executed) < 10)
+        statements = '\n'.join(executed)
+        self.assertEqual(statements.count('INSERT INTO a VALUES'), 10)
+        self.assertEqual(statements.count('clock_timestamp()'), 20)
+
+    def test_postgres_pipelines_with_file_tracers(self):
+        directory = self.migration_directory(**dict(
+            ('2012011507%04d-m.sql' % i, 'INSERT INTO a VALUES (%d);' % i)
+            for i in range(10)))
+        engine = dbengines.postgres.__new__(dbengines.postgres)
+        engine.deploy = 'deploy'
+        engine.pipeline_size = 2000
+        migrations = [
+            dbengines.Migration(engine, filename, '0' * 40,
+                                os.path.join(directory, filename))
+            for filename in sorted(os.listdir(directory))]
+        result = api.Result(False)
+        engine.tracer = tracing.Tracers(
+            [api.ResultTracer(result, directory)])
+        executed = []
+        cursor = mock.Mock(rowcount=1)
+        cursor.execute = executed.append
+        engine.apply_batch(cursor, migrations)
+        self.assertTrue(1 < len(executed) < 10)
+        self.assertEqual(
+            [m.filename for m in result.performed],
+            [m.filename for m in migrations])
+
+        # a tracer that times statements gets every one of them
+        engine.tracer.append(tracing.Tracer())
+        del executed[:]
+        engine.apply_batch(cursor, migrations)
+        self.assertEqual(len(executed), 20)
+
+    def test_postgres_batches_time_scripts(self):
+        engine = dbengines.postgres.__new__(dbengines.postgres)
+        engine.tracer = tracing.Tracers()
+        engine.deploy = 'deploy'
+        engine.pipeline_size = 2000
+        script = dbengines.Migration(engine, '20120115075349-a.sh', '0' * 40)
+        script.started = (
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=3))
+        executed = []
+        cursor = mock.Mock()
+        cursor.execute = executed.append
+        engine.apply_batch(cursor, [script])
+        self.assertEqual(len(executed), 1)
+        self.assertNotIn('clock_timestamp()', executed[0])
+        self.assertIn(
+            script.started.strftime('%Y-%m-%d %H:%M:%S'), executed[0])
+        duration = re.search(r', (\d+), NULL, ', executed[0]).group(1)
+        self.assertGreaterEqual(int(duration), 3000)
+
+    def test_pending_migrations(self):
+        F = dbengines.FilenameSha1
+        current = [F('1-a.sql', 'x'), F('2-b.sql', 'y'), F('4-d.sql', 'w'),
+                   F('5-e.sql', 'v'), F('6-f.sql', 'u')]
+        self.assertEqual(
+            pending_migrations(current, current[:3]),
+            (current[3:], [], set(), set()))
+        performed = [F('1-a.sql', 'x'), F('2-b.sql', 'z'), F('3-c.sql', 'q'),
+                     F('5-e.sql', 'v')]
+        self.assertEqual(
+            pending_migrations(reversed(current), performed),
+            ([F('2-b.sql', 'y'), F('4-d.sql', 'w'), F('6-f.sql', 'u')],
+             ['2-b.sql', '4-d.sql'], set(['2-b.sql']), set(['3-c.sql'])))
+
+    def test_dependencies(self):
+        directory = self.migration_directory(**{
+            '1-a.sql': 'CREATE TABLE a (id int);',
+            '2-a-index.sql': (
+                '-- build the index\n'
+                '-- depends: 1-a.sql\n'
+                'CREATE INDEX a_id ON a (id);'),
+            '3-b.sql': '\n-- depends: 0-old.sql\nCREATE TABLE b (id int);',
+            '4-c.sql': 'CREATE TABLE c (id int);',
+            '5-c-index.sql': (
+                '-- depends: 2-a-index.sql, 4-c.sql\n'
+                'CREATE INDEX c_id ON c (id);'),
+            '6-d.sql': '-- depends:\nCREATE TABLE d (id int);'})
+        self.settings['directory'] = directory
+        mariposa = DBMigrate(**self.settings)
+        migrations = [
+            migration for command, migration in mariposa.engine.sql(
+                directory, mariposa.current_migrations())]
+        self.assertEqual(
+            scheduler.dependencies(migrations, set(['0-old.sql'])), {
+                '1-a.sql': set(),
+                '2-a-index.sql': set(['1-a.sql']),
+                '3-b.sql': set(['1-a.sql']),
+                '4-c.sql': set([
+                    '1-a.sql', '2-a-index.sql', '3-b.sql']),
+                '5-c-index.sql': set(['2-a-index.sql', '4-c.sql']),
+                '6-d.sql': set(['4-c.sql'])})
+        self.assertRaises(
+            scheduler.DependencyException,
+            scheduler.dependencies, migrations, set())
+
+    def test_run_graph(self):
+        Node = collections.namedtuple('Node', 'filename')
+        nodes = [Node(name) for name in 'abcd']
+        graph = {'a': set(), 'b': set(['a']), 'c': set(['a']),
+                 'd': set(['b', 'c'])}
+        finished = []
+        both_running = threading.Barrier(2, timeout=5)
+
+        def run(node):
+            if node.filename in 'bc':
+                # b and c only get past here if they are running at once
+                both_running.wait()
+            finished.append(node.filename)
+        scheduler.run_graph(nodes, graph, run, 2)
+        self.assertEqual(finished[0], 'a')
+        self.assertEqual(sorted(finished[1:3]), ['b', 'c'])
+        self.assertEqual(finished[3], 'd')
+
+        def fail(node):
+            finished.append(node.filename)
+            if node.filename == 'a':
+                raise ValueError('a failed')
+        del finished[:]
+        self.assertRaises(
+            ValueError, scheduler.run_graph, nodes, graph, fail, 2)
+        self.assertEqual(finished, ['a'])
+
+    def test_parallel_migration(self):
+        if self.settings['engine'] == 'sqlite':
+            database = os.path.join(self.migration_directory(), 'test.db')
+            self.settings['connection_string'] = database
+        self.settings['directory'] = self.migration_directory(**{
+            '1-a.sql': 'CREATE TABLE a (id int);',
+            '2-b.sql': '-- depends: 1-a.sql\nCREATE TABLE b (id int);',
+            '3-c.sql': '-- depends: 1-a.sql\nCREATE TABLE c (id int);',
+            '4-d.sql': 'CREATE TABLE d (id int);'})
+        mariposa = DBMigrate(**self.settings)
+        mariposa.engine.parallel_workers = 3
+        mariposa.migrate()
+        self.assertEqual(
+            sorted(mariposa.engine.performed_migrations()),
+            sorted(mariposa.current_migrations()))
+
+    def test_status_and_plan(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);',
+            '20120115075350-b.sql': 'CREATE TABLE b (id int);'})
+        mariposa = DBMigrate(**self.settings)
+        a, b = sorted(mariposa.current_migrations())
+        self.assertEqual(mariposa.status(), (
+            '0 migrations performed, 2 pending\n'
+            'pending: 20120115075349-a.sql\n'
+            'pending: 20120115075350-b.sql'))
+        self.assertEqual(mariposa.plan(), '%s %s\n%s %s' % (a + b))
+        mariposa.migrations = [a]
+        mariposa.migrate()
+        mariposa.migrations = None
+        self.assertEqual(mariposa.plan(), '%s %s' % b)
+        mariposa.migrate()
+        self.assertEqual(
+            mariposa.status(), 'Up to date (2 migrations performed)')
+        self.assertEqual(mariposa.plan(), '')
+
+        mariposa.migrations = [a, b._replace(sha1='0' * 40)]
+        self.assertEqual(mariposa.status(), (
+            '2 migrations performed, 1 pending\n'
+            'modified: 20120115075350-b.sql'))
+        self.assertRaises(ModifiedMigrationException, mariposa.plan)
+        mariposa.migrations = [b]
+        self.assertEqual(mariposa.status(), (
+            '2 migrations performed, 0 pending\n'
+            'deleted: 20120115075349-a.sql'))
+
+    def test_status_from_snapshot_does_not_connect(self):
+        directory = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);'})
+        self.settings['directory'] = directory
+        self.settings['snapshot'] = os.path.join(
+            self.migration_directory(), 'performed.json')
+        mariposa = DBMigrate(**self.settings)
+        mariposa.migrate()
+        self.assertEqual(
+            json.load(open(self.settings['snapshot'])),
+            [list(m) for m in mariposa.current_migrations()])
+
+        mariposa = DBMigrate(**self.settings)
+        mariposa.connect = lambda: self.fail('should not have connected')
+        self.assertEqual(
+            mariposa.status(), 'Up to date (1 migrations performed)')
+        open(os.path.join(directory, '20120115075350-b.sql'), 'w').write(
+            'CREATE TABLE b (id int);')
+        self.assertEqual(mariposa.status(), (
+            '1 migrations performed, 1 pending\n'
+            'pending: 20120115075350-b.sql'))
+        self.assertTrue(mariposa.plan().startswith('20120115075350-b.sql '))
+        self.assertEqual(mariposa._engine, None)
+
+    def test_import_is_lazy(self):
+        # drivers and other modules that slow down startup are imported
+        # when they're first needed
+        modules = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, mariposa.core; print(" ".join(sorted(sys.modules)))'
+        ]).decode('UTF-8').split()
+        for module in ('sqlite3', 'subprocess', 'socket', 'psycopg2',
+                       'MySQLdb', 'concurrent.futures'):
+            self.assertFalse(module in modules, module)
+
+    def test_watch(self):
+        directory = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);'})
+        self.settings['directory'] = directory
+        mariposa = DBMigrate(**self.settings)
+        warnings = []
+        mariposa.warn = warnings.append
+
+        def write(filename, contents):
+            path = os.path.join(directory, filename)
+            open(path, 'w').write(contents)
+            os.utime(path, (len(steps), len(steps)))
+        steps = [
+            lambda: None,
+            lambda: write('20120115075350-b.sql', 'CREATE TABLE b (id int);'),
+            lambda: write('20120115075351-c.sql', 'CREATE TABLE b (id int);'),
+            lambda: write('20120115075351-c.sql', 'CREATE TABLE c (id int);'),
+            lambda: write('20120115075351-c.sql', 'CREATE TABLE z (id int);'),
+        ]
+
+        def sleep(interval):
+            if not steps:
+                raise KeyboardInterrupt
+            steps.pop(0)()
+        mariposa.watch(0, sleep)
+        self.assertEqual(
+            [m.filename for m in mariposa.engine.performed_migrations()], [
+                '20120115075349-a.sql', '20120115075350-b.sql',
+                '20120115075351-c.sql'])
+        self.assertEqual(len(warnings), 2)
+        self.assertTrue(
+            warnings[0].startswith('[20120115075351-c.sql] failed'))
+        self.assertEqual(warnings[1], (
+            '[20120115075351-c.sql] migrations were modified since they were '
+            'run on this database.'))
+
+    def test_python_migration(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);',
+            '20120115075350-b.py': (
+                'def migrate(connection):\n'
+                '    cursor = connection.cursor()\n'
+                '    cursor.execute("INSERT INTO a VALUES (1)")\n'),
+            '20120115075351-c.py': (
+                'def migrate(connection):\n'
+                '    cursor = connection.cursor()\n'
+                '    cursor.execute("INSERT INTO a VALUES (2)")\n'
+                '    raise ValueError("c failed")\n')})
+        mariposa = DBMigrate(**self.settings)
+        self.assertRaises(ValueError, mariposa.migrate)
+        # c is rolled back along with its row in dbmigration
+        self.assertEqual(mariposa.engine.results('SELECT id FROM a'), [(1,)])
+        self.assertEqual(
+            [m.filename for m in mariposa.engine.performed_migrations()],
+            ['20120115075349-a.sql', '20120115075350-b.py'])
+        mariposa.dry_run = True
+        self.assertTrue(
+            '-- migrate(connection) from ' in mariposa.migrate())
+
+    def test_create_python_migration(self):
+        self.settings['directory'] = '/tmp'
+        mariposa = DBMigrate(**self.settings)
+        fake_file = FakeFile()
+        mariposa.create('test slug', 'py', fake_file)
+        self.assertTrue(fake_file.contents.startswith(
+            'def migrate(connection):\n'))
+
+    def test_script_output_and_timeout(self):
+        directory = self.migration_directory()
+        script = os.path.join(directory, '20120115075349-a.sh')
+        open(script, 'w').write('#!/bin/sh\necho hello\nsleep 5\n')
+        os.chmod(script, 0o755)
+        self.settings['directory'] = directory
+        self.settings['script_timeout'] = 0.5
+        mariposa = DBMigrate(**self.settings)
+        stdout = io.StringIO()
+        with mock.patch('sys.stdout', stdout):
+            self.assertRaises(subprocess.TimeoutExpired, mariposa.migrate)
+        self.assertEqual(stdout.getvalue(), '[20120115075349-a.sh] hello\n')
+        self.assertEqual(mariposa.engine.performed_migrations(), [])
+
+    def test_backfill_migration_resumes(self):
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': (
+                'CREATE TABLE a (id int, n int);\n' +
+                ''.join('INSERT INTO a VALUES (%d, 0);\n' % i
+                        for i in range(1, 26))),
+            '20120115075350-b.backfill': (
+                '-- table: a\n'
+                '-- key: id\n'
+                '-- batch-size: 10\n'
+                '-- pause: 1\n'
+                'UPDATE a SET n = n + 1 WHERE id >= :start AND id <= :end;\n'
+            )})
+        mariposa = DBMigrate(**self.settings)
+
+        class Interrupted(Exception):
+            pass
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 2:
+                raise Interrupted()
+        with mock.patch('time.sleep', sleep):
+            self.assertRaises(Interrupted, mariposa.migrate)
+        self.assertEqual(sleeps, [1, 1])
+        self.assertEqual(
+            [m.filename for m in mariposa.engine.performed_migrations()],
+            ['20120115075349-a.sql'])
+        self.assertEqual(mariposa.engine.results(
+            'SELECT filename, last_key, rows_affected '
+            'FROM dbmigration_progress'),
+            [('20120115075350-b.backfill', '20', 20)])
+
+        with mock.patch('time.sleep', sleeps.append):
+            mariposa.migrate()
+        self.assertEqual(len(sleeps), 3)
+        self.assertEqual(mariposa.engine.results(
+            'SELECT n, COUNT(*) FROM a GROUP BY n'), [(1, 25)])
+        self.assertEqual(mariposa.engine.results(
+            "SELECT rows_affected FROM dbmigration "
+            "WHERE filename = '20120115075350-b.backfill'"), [(25,)])
+        self.assertEqual(mariposa.engine.results(
+            'SELECT * FROM dbmigration_progress'), [])
+
+    def test_migration_lock(self):
+        if self.settings['engine'] != 'sqlite':
+            self.skipTest('needs two sqlite connections to one database')
+        self.settings['connection_string'] = os.path.join(
+            self.migration_directory(), 'test.db')
+        self.settings['directory'] = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);'})
+        first = DBMigrate(**self.settings)
+        self.assertTrue(first.engine.lock(0))
+        self.assertTrue(first.engine.lock(0))
+
+        self.settings['lock_timeout'] = 0.1
+        second = DBMigrate(**self.settings)
+        second.engine.lock_poll_interval = 0.01
+        self.assertFalse(second.engine.lock(0.1))
+        self.assertRaises(dbengines.LockTimeoutException, second.migrate)
+
+        # the node that was waiting finds the database up to date
+        self.settings['lock_timeout'] = 10
+        third = DBMigrate(**self.settings)
+        third.engine.lock_poll_interval = 0.01
+        planned = []
+
+        class RecordingTracer(tracing.Tracer):
+            def plan_computed(self, migrations, duration):
+                planned.append(migrations)
+        third.tracer.append(RecordingTracer())
+        waiting = threading.Thread(target=third.migrate)
+        waiting.start()
+        first.migrate()
+        waiting.join()
+        self.assertEqual(planned, [])
+        self.assertEqual(first.engine.results(
+            'SELECT COUNT(*) FROM dbmigration_lock'), [(0,)])
+
+    def test_abandoned_migration_lock_is_taken_over(self):
+        if self.settings['engine'] != 'sqlite':
+            self.skipTest('checks the sqlite lock row')
+        self.settings['directory'] = self.migration_directory()
+        mariposa = DBMigrate(**self.settings)
+        exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+        exited.wait()
+        mariposa.engine.execute(mariposa.engine.lock_table)
+        mariposa.engine.connection.execute(
+            "INSERT INTO dbmigration_lock VALUES (?, ?, 'gone', ?)",
+            (dbengines.hostname(), exited.pid, time.time()))
+        mariposa.engine.connection.commit()
+        self.assertTrue(mariposa.engine.lock(0))
+        mariposa.engine.connection.execute(
+            "UPDATE dbmigration_lock SET owner = 'alive', pid = ?",
+            (os.getpid(),))
+        mariposa.engine.connection.commit()
+        self.assertFalse(mariposa.engine.lock(0))
+
+        # a crashed container is on another host and its pid may be reused
+        # but it stops refreshing its heartbeat
+        mariposa.engine.connection.execute(
+            "UPDATE dbmigration_lock SET host = 'gone', heartbeat = ?",
+            (time.time() - mariposa.engine.lock_expiry - 1,))
+        mariposa.engine.connection.commit()
+        self.assertTrue(mariposa.engine.lock(0))
+        mariposa.engine.unlock()
+
+    def test_migration_lock_heartbeat(self):
+        if self.settings['engine'] != 'sqlite':
+            self.skipTest('checks the sqlite lock row')
+        self.settings['connection_string'] = os.path.join(
+            self.migration_directory(), 'test.db')
+        self.settings['directory'] = self.migration_directory()
+        first = DBMigrate(**self.settings)
+        first.engine.heartbeat_interval = 0.01
+        self.assertTrue(first.engine.lock(0))
+        first.engine.connection.execute(
+            'UPDATE dbmigration_lock SET heartbeat = 0')
+        first.engine.connection.commit()
+        second = DBMigrate(**self.settings)
+        deadline = time.time() + 5
+        while second.engine.results(
+                'SELECT heartbeat FROM dbmigration_lock') == [(0,)]:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+        self.assertFalse(second.engine.lock(0))
+        first.engine.unlock()
+        self.assertEqual(first.engine.heartbeat, None)
+        self.assertTrue(second.engine.lock(0))
+        second.engine.close()
+
+    def test_bundle(self):
+        directory = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);',
+            '20120115075350-b.csv': '-- table: a\nid\n1\n2\n',
+            '20120115075351-c.py': (
+                'def migrate(connection):\n'
+                '    connection.cursor().execute("INSERT INTO a VALUES (3)")\n'
+            )})
+        script = os.path.join(directory, '20120115075352-d.sh')
+        open(script, 'w').write('#!/bin/sh\necho from the bundle\n')
+        os.chmod(script, 0o755)
+        self.settings['directory'] = directory
+        mariposa = DBMigrate(**self.settings)
+        packed = os.path.join(self.migration_directory(), 'migrations.bundle')
+        mariposa.bundle(packed)
+
+        self.settings['directory'] = packed
+        bundled = DBMigrate(**self.settings)
+        self.assertEqual(bundled.current_migrations(),
+                         sorted(mariposa.current_migrations()))
+        stdout = io.StringIO()
+        with mock.patch('sys.stdout', stdout):
+            bundled.migrate()
+        self.assertEqual(
+            stdout.getvalue(), '[20120115075352-d.sh] from the bundle\n')
+        self.assertEqual(
+            bundled.engine.results('SELECT id FROM a ORDER BY id'),
+            [(1,), (2,), (3,)])
+        self.assertEqual(
+            sorted(bundled.engine.performed_migrations()),
+            sorted(mariposa.current_migrations()))
+
+    def test_corrupt_bundle(self):
+        directory = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);'})
+        packed = os.path.join(directory, 'migrations.bundle')
+        self.settings['directory'] = directory
+        DBMigrate(**self.settings).bundle(packed)
+        contents = open(packed, 'rb').read()
+        open(packed, 'wb').write(contents.replace(b'TABLE a', b'TABLE b'))
+        self.settings['directory'] = packed
+        mariposa = DBMigrate(**self.settings)
+        self.assertRaises(BundleException, mariposa.migrate)
+
+    def test_dry_run_written_to_output(self):
+        self.settings['directory'] = os.path.join(
+            os.path.dirname(__file__), 'fixtures', 'initial')
+        self.settings['dry_run'] = True
+        expected = DBMigrate(**self.settings).migrate()
+        self.settings['output'] = io.StringIO()
+        mariposa = DBMigrate(**self.settings)
+        self.assertEqual(mariposa.migrate(), None)
+        self.assertEqual(self.settings['output'].getvalue(), expected + '\n')
+
+    def test_apply_plan(self):
+        directory = self.migration_directory(**{
+            '20120115075349-a.sql': 'CREATE TABLE a (id int);',
+            '20120115075350-b.sql': 'INSERT INTO a VALUES (1);'})
+        self.settings['directory'] = directory
+        plan = os.path.join(self.migration_directory(), 'plan.json')
+        mariposa = DBMigrate(**self.settings)
+        mariposa.plan(plan)
+
+        mariposa.apply_plan = plan
+        mariposa.current_migrations = lambda: self.fail('should not hash')
+        mariposa.migrate()
+        self.assertEqual(mariposa.engine.results('SELECT id FROM a'), [(1,)])
+        # applying it again finds it has already been applied
+        mariposa.migrate()
+        self.assertEqual(mariposa.engine.results('SELECT id FROM a'), [(1,)])
+        del mariposa.current_migrations
+        mariposa.apply_plan = None
+        self.assertEqual(mariposa.status(),
+                         'Up to date (2 migrations performed)')
+
+        # a plan for a database in a different state isn't applied
+        open(os.path.join(directory, '20120115075351-c.sql'), 'w').write(
+            'INSERT INTO a VALUES (2);')
+        fresh = DBMigrate(**self.settings)
+        fresh.plan(plan)
+        mariposa.apply_plan = plan
+        self.assertRaises(plans.PlanException, mariposa.migrate)
+
+        contents = json.load(open(plan))
+        contents['migrations'].pop()
+        json.dump(contents, open(plan, 'w'))
+        fresh.apply_plan = plan
+        self.assertRaises(plans.PlanException, fresh.migrate)
+
+    def test_apply_plan_with_a_changed_migration(self):
+        directory = self.migration_directory(**{
+            '20120101000000-a.sql': 'CREATE TABLE a (id int);'})
+        self.settings['directory'] = directory
+        plan = os.path.join(self.migration_directory(), 'plan.json')
+        mariposa = DBMigrate(**self.settings)
+        mariposa.plan(plan)
+        open(os.path.join(directory, '20120101000000-a.sql'), 'w').write(
+            'CREATE TABLE zzz (id int);')
+        mariposa.apply_plan = plan
+        for dry_run in (True, False):
+            mariposa.dry_run = dry_run
+            with self.assertRaises(plans.PlanException) as e:
+                mariposa.migrate()
+            self.assertEqual(
+                str(e.exception),
+                '[20120101000000-a.sql] changed since the plan was made.')
+        self.assertEqual(mariposa.performed_migrations(), [])
+        self.assertRaises(
+            SQLException, mariposa.engine.results, 'SELECT * FROM zzz')
+
+        os.remove(os.path.join(directory, '20120101000000-a.sql'))
+        self.assertRaises(plans.PlanException, mariposa.migrate)
+
+    def test_nested_directories(self):
+        directory = self.migration_directory(**{
+            '2012/01/20120115075349-a.sql': 'CREATE TABLE a (id int);',
+            '2012/02/20120215075349-b.sql': 'INSERT INTO a VALUES (1);',
+            '20120315075349-c.sql': 'INSERT INTO a VALUES (2);',
+            '2012/02/.20120215075350-swap.sql': 'not a migration',
+            '.git/20120215075351-d.sql': 'not a migration either'})
+        self.settings['directory'] = directory
+        mariposa = DBMigrate(**self.settings)
+        self.assertEqual(
+            [m.filename for m in mariposa.current_migrations()],
+            ['20120115075349-a.sql', '20120215075349-b.sql',
+             '20120315075349-c.sql'])
+        mariposa.migrate()
+        self.assertEqual(
+            mariposa.engine.results('SELECT id FROM a ORDER BY id'),
+            [(1,), (2,)])
+
+        # moving a migration into a subdirectory changes nothing
+        os.rename(os.path.join(directory, '20120315075349-c.sql'),
+                  os.path.join(directory, '2012', '20120315075349-c.sql'))
+        self.assertEqual(mariposa.status(),
+                         'Up to date (3 migrations performed)')
+
+        # bundles are flat
+        packed = os.path.join(self.migration_directory(), 'migrations.bundle')
+        mariposa.bundle(packed)
+        self.settings['directory'] = packed
+        self.assertEqual(DBMigrate(**self.settings).current_migrations(),
+                         mariposa.current_migrations())
+
+        open(os.path.join(directory, '2012', '01', '20120315075349-c.sql'),
+             'w').write('INSERT INTO a VALUES (3);')
+        self.assertRaises(scanning.DuplicateMigrationException,
+                          mariposa.current_migrations)
+
+    def test_since(self):
+        directory = self.migration_directory(**{
+            '2012/01/20120115075349-a.sql': 'CREATE TABLE a (id int);',
+            '2012/02/20120215075349-b.sql': 'INSERT INTO a VALUES (1);'})
+        self.settings['directory'] = directory
+        mariposa = DBMigrate(**self.settings)
+        mariposa.migrate()
+        mariposa.since = 'latest'
+        self.assertEqual(
+            mariposa.migration_files(mariposa.watermark()).skipped,
+            ['201201'])
+        hashed = []
+        mariposa.blobsha1 = hashed.append
+        # what was performed in the skipped subdirectory is taken as current
+        self.assertEqual(mariposa.status(),
+                         'Up to date (2 migrations performed)')
+        self.assertEqual(hashed, [])
+        del mariposa.blobsha1
+
+        open(os.path.join(directory, '2012', '02', '20120215075350-c.sql'),
+             'w').write('INSERT INTO a VALUES (2);')
+        mariposa.since = '20120201'
+        mariposa.migrate()
+        self.assertEqual(
+            mariposa.engine.results('SELECT id FROM a ORDER BY id'),
+            [(1,), (2,)])
+        mariposa.since = None
+        self.assertEqual(mariposa.status(),
+                         'Up to date (3 migrations performed)')
+
+    def test_since_latest_up_to_date(self):
+        directory = self.migration_directory(**{
+            '2011/20111215075349-a.sql': 'CREATE TABLE a (id int);',
+            '2012/01/20120115075349-b.sql': 'INSERT INTO a VALUES (1);',
+            '2012/02/20120215075349-c.sql': 'INSERT INTO a VALUES (2);',
+            '20120301000000-d.sql': 'INSERT INTO a VALUES (3);'})
+        self.settings['directory'] = directory
+        mariposa = DBMigrate(**self.settings)
+        mariposa.migrate()
+        mariposa.since = 'latest'
+        performed_migrations = mariposa.engine.performed_migrations
+
+        def fetch_history():
+            self.fail('the whole history was fetched')
+        mariposa.engine.performed_migrations = fetch_history
+        mariposa.migrate()
+        self.assertEqual(
+            mariposa.scanned_migrations()[1], ['2011', '201201', '201202'])
+
+        # the history is only fetched once there is something to run
+        open(os.path.join(directory, '20120401000000-e.sql'), 'w').write(
+            'INSERT INTO a VALUES (4);')
+        self.assertRaises(AssertionError, mariposa.migrate)
+        mariposa.engine.performed_migrations = performed_migrations
+        mariposa.migrate()
+        self.assertEqual(len(mariposa.engine.performed_migrations()), 5)
+
+        # deleting a migration that isn't in a skipped subdirectory is
+        # still noticed
+        os.remove(os.path.join(directory, '20120301000000-d.sql'))
+        self.assertFalse(mariposa.up_to_date(*mariposa.scanned_migrations()))
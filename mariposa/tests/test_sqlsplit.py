@@ -0,0 +1,88 @@
+from mariposa.sqlsplit import split_statements
+
+import unittest
+
+
+def split(sql, dialect=None):
+    return list(split_statements(sql.splitlines(), dialect))
+
+
+class TestSplitStatements(unittest.TestCase):
+    def test_simple_statements(self):
+        self.assertEqual(
+            split('CREATE TABLE a (id int);\nINSERT INTO a VALUES (1);'),
+            ['CREATE TABLE a (id int)', 'INSERT INTO a VALUES (1)'])
+
+    def test_unterminated_final_statement(self):
+        self.assertEqual(
+            split('SELECT 1;\nSELECT 2\n'), ['SELECT 1', 'SELECT 2'])
+
+    def test_comment_only_statements_skipped(self):
+        self.assertEqual(split('-- nothing to see here\n/* ; */\n;'), [])
+
+    def test_comments_stay_with_their_statement(self):
+        self.assertEqual(
+            split('-- a comment; with a semicolon\nSELECT 1; -- trailing'),
+            ['-- a comment; with a semicolon\nSELECT 1'])
+
+    def test_block_comments(self):
+        self.assertEqual(
+            split('SELECT /* ; */ 1;\n/* multi\n line; */ SELECT 2;'),
+            ['SELECT /* ; */ 1', '/* multi\n line; */ SELECT 2'])
+
+    def test_quotes(self):
+        self.assertEqual(
+            split("INSERT INTO a VALUES ('it''s; here', \"b;\");\nSELECT 1;"),
+            ["INSERT INTO a VALUES ('it''s; here', \"b;\")", 'SELECT 1'])
+
+    def test_postgres_escape_strings(self):
+        self.assertEqual(
+            split("SELECT E'a\\'b;c';\nSELECT e'\\\\';\nSELECT 2;",
+                  'postgres'),
+            ["SELECT E'a\\'b;c'", "SELECT e'\\\\'", 'SELECT 2'])
+        # a backslash is just a backslash in a standard string
+        self.assertEqual(
+            split("SELECT 'a\\';\nSELECT 2;", 'postgres'),
+            ["SELECT 'a\\'", 'SELECT 2'])
+
+    def test_multiline_string(self):
+        self.assertEqual(
+            split("INSERT INTO a VALUES ('one;\ntwo');"),
+            ["INSERT INTO a VALUES ('one;\ntwo')"])
+
+    def test_sqlite_trigger(self):
+        sql = (
+            'CREATE TRIGGER t AFTER INSERT ON a BEGIN\n'
+            '  INSERT INTO b VALUES (1);\n'
+            '  INSERT INTO b VALUES (2);\n'
+            'END;\n'
+            'SELECT 1;')
+        self.assertEqual(split(sql, 'sqlite'), [
+            'CREATE TRIGGER t AFTER INSERT ON a BEGIN\n'
+            '  INSERT INTO b VALUES (1);\n'
+            '  INSERT INTO b VALUES (2);\n'
+            'END',
+            'SELECT 1'])
+
+    def test_postgres_dollar_quoting(self):
+        sql = (
+            'CREATE FUNCTION f() RETURNS int AS $body$\n'
+            'BEGIN RETURN 1; END;\n'
+            '$body$ LANGUAGE plpgsql;\n'
+            "SELECT $$a;b$$, a$b FROM c;")
+        self.assertEqual(split(sql, 'postgres'), [
+            'CREATE FUNCTION f() RETURNS int AS $body$\n'
+            'BEGIN RETURN 1; END;\n'
+            '$body$ LANGUAGE plpgsql',
+            'SELECT $$a;b$$, a$b FROM c'])
+
+    def test_mysql_delimiter(self):
+        sql = (
+            'DELIMITER //\n'
+            'CREATE PROCEDURE p() BEGIN SELECT 1; SELECT 2; END//\n'
+            'DELIMITER ;\n'
+            "SELECT 'it\\'s;' # a comment;\n"
+            ';')
+        self.assertEqual(split(sql, 'mysql'), [
+            'CREATE PROCEDURE p() BEGIN SELECT 1; SELECT 2; END',
+            "SELECT 'it\\'s;' # a comment;"])
@@ -0,0 +1,165 @@
+import logging
+import re
+import threading
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+logger = logging.getLogger(__name__)
+
+LEADING_COMMENTS = re.compile(r'^(\s*(--[^\n]*\n|/\*.*?\*/))*\s*', re.DOTALL)
+DML = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+
+def first_keyword(statement):
+    """returns the first word of a statement after any leading comments"""
+    words = statement[LEADING_COMMENTS.match(statement).end():].split(None, 1)
+    return words[0].upper() if words else ''
+
+
+class Tracer(object):
+    """receives events as migrations are planned and performed
+
+    durations are wall-clock seconds and error is the exception that
+    stopped a file or statement (if any). subclasses override the events
+    they are interested in"""
+
+    # whether the tracer needs statement events. postgres only sends them
+    # when it doesn't pipeline the statements of a batch
+    wants_statements = True
+
+    def plan_computed(self, migrations, duration):
+        pass
+
+    def file_started(self, migration):
+        pass
+
+    def file_finished(self, migration, duration, error=None):
+        pass
+
+    def statement_started(self, migration, statement):
+        pass
+
+    def statement_finished(self, migration, statement, duration, cursor,
+                           error=None):
+        pass
+
+    def close(self):
+        """releases anything the tracer holds on to once migrate is done"""
+        pass
+
+
+class Tracers(Tracer):
+    """passes every event along to a list of tracers"""
+
+    def __init__(self, tracers=None):
+        self.tracers = list(tracers or [])
+
+    def __len__(self):
+        return len(self.tracers)
+
+    @property
+    def wants_statements(self):
+        return any(tracer.wants_statements for tracer in self.tracers)
+
+    def append(self, tracer):
+        self.tracers.append(tracer)
+
+    def _event(name):
+        def event(self, *args, **kwargs):
+            for tracer in self.tracers:
+                getattr(tracer, name)(*args, **kwargs)
+        event.__name__ = name
+        return event
+
+    plan_computed = _event('plan_computed')
+    file_started = _event('file_started')
+    file_finished = _event('file_finished')
+    statement_started = _event('statement_started')
+    statement_finished = _event('statement_finished')
+    close = _event('close')
+    del _event
+
+
+class JSONLinesTracer(Tracer):
+    """appends every event to a file as a line of JSON"""
+
+    # the most of a statement that is written to the trace
+    statement_length = 1000
+
+    def __init__(self, filename):
+        self.file = open(filename, 'a')
+        self.lock = threading.Lock()
+
+    def write(self, event, migration=None, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        if migration is not None:
+            fields['filename'] = migration.filename
+            fields['sha1'] = migration.sha1
+        if 'duration' in fields:
+            fields['duration_ms'] = int(fields.pop('duration') * 1000)
+        if fields.get('error') is not None:
+            fields['error'] = str(fields['error'])
+        if 'statement' in fields:
+            fields['statement'] = fields['statement'][:self.statement_length]
+        with self.lock:
+            self.file.write(json.dumps(fields, sort_keys=True) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def plan_computed(self, migrations, duration):
+        self.write('plan_computed', duration=duration,
+                   migrations=[m.filename for m in migrations])
+
+    def file_started(self, migration):
+        self.write('file_started', migration)
+
+    def file_finished(self, migration, duration, error=None):
+        self.write('file_finished', migration, duration=duration, error=error)
+
+    def statement_started(self, migration, statement):
+        self.write('statement_started', migration, statement=statement)
+
+    def statement_finished(self, migration, statement, duration, cursor,
+                           error=None):
+        self.write('statement_finished', migration, statement=statement,
+                   duration=duration, error=error)
+
+
+class SlowStatementTracer(Tracer):
+    """logs statements that take longer than threshold seconds along with
+    the query plan of slow DML when explain is set and the engine can
+
+    the plan comes from the engine (and so the connection) that ran the
+    statement. statements with parameters (such as a backfill's) can't be
+    explained on their own and a plan that can't be had is only logged,
+    since the statement itself succeeded"""
+
+    def __init__(self, threshold, explain=False):
+        self.threshold = threshold
+        self.explain = explain
+
+    def statement_finished(self, migration, statement, duration, cursor,
+                           error=None):
+        if error is not None or duration < self.threshold:
+            return
+        message = 'slow statement in %s (%d ms): %s' % (
+            migration.filename, duration * 1000, statement)
+        engine = migration.engine
+        if (self.explain and first_keyword(statement) in DML and
+                engine.placeholder not in statement):
+            try:
+                plan = engine.explain(statement)
+            except Exception as e:
+                logger.warning('unable to explain a statement in %s: %s',
+                               migration.filename, e)
+                plan = None
+            if plan:
+                message += '\n' + '\n'.join(plan)
+        logger.warning(message)
@@ -9,4 +9,5 @@ setup(
     author_email='dan.bravender@gmail.com',
     entry_points={'console_scripts': ['mariposa = mariposa.core:main']},
     packages=['mariposa'],
+    python_requires='>=3.7',
 )